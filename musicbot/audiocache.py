@@ -0,0 +1,385 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from collections import namedtuple
+
+from .utils import md5sum
+
+log = logging.getLogger(__name__)
+
+CachedFile = namedtuple("CachedFile", "name size duration content_hash")
+
+# The values ffmpeg's loudnorm filter measures in its first pass, see URLPlaylistEntry.measure_loudness
+LOUDNESS_FIELDS = ("input_i", "input_lra", "input_tp", "input_thresh", "target_offset")
+
+# Files yt-dlp is still writing to, they only become part of the cache once they're renamed
+_partial_suffixes = (".part", ".ytdl", ".temp")
+
+
+class AudioCache:
+    """
+    Keeps an index of the files in the audio cache folder in a sqlite file, so finding out whether a song is
+    already downloaded doesn't mean listing the whole folder.  Besides the file's size it remembers the duration,
+    and the loudness measured for equalization keyed by the file's content hash, so a cached song doesn't have
+    to be probed or analysed again.
+
+    The index is reconciled with the folder once, on the first lookup after the bot starts (or after the folder
+    was wiped), and is kept up to date by the bot as it downloads and deletes files after that.
+
+    With a `max_size` in bytes, the least recently played files are deleted once the folder grows past it.
+    Files that are queued or playing are pinned and never deleted.
+    """
+
+    def __init__(self, folder, path, *, max_size=0):
+        self.folder = folder
+        self.path = path
+        self.max_size = max_size
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._pins = {}
+        self._lock = threading.Lock()
+        self._synced = False
+        self._db = None
+
+        self._open_db()
+
+    def _open_db(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None
+            )
+            # every lookup commits, in WAL mode a commit doesn't wait for the disk
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._create_tables()
+        except sqlite3.Error:
+            log.warning(
+                "Could not open audio cache index {}, keeping it in memory".format(
+                    self.path
+                ),
+                exc_info=True,
+            )
+            self.path = ":memory:"
+            self._open_db()
+
+    def _create_tables(self):
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                stem TEXT NOT NULL,
+                base TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                duration REAL,
+                added REAL NOT NULL,
+                last_used REAL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                content_hash TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_stem ON files (stem);
+            CREATE INDEX IF NOT EXISTS files_base ON files (base);
+            CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used);
+            CREATE TABLE IF NOT EXISTS loudness (
+                hash TEXT PRIMARY KEY,
+                input_i REAL NOT NULL,
+                input_lra REAL NOT NULL,
+                input_tp REAL NOT NULL,
+                input_thresh REAL NOT NULL,
+                target_offset REAL NOT NULL,
+                measured REAL NOT NULL
+            );
+            """
+        )
+
+    @staticmethod
+    def _names(name):
+        # the stem is the name without extension, the base also drops the content hash generic downloads get
+        stem = name.rsplit(".", 1)[0]
+        base = name.rsplit("-", 1)[0]
+        return stem, base
+
+    def invalidate(self):
+        """
+        Makes the next lookup reconcile the index with the folder again, for when the folder changed behind our back.
+        """
+        self._synced = False
+
+    async def sync(self, loop):
+        if not self._synced:
+            await loop.run_in_executor(None, self._sync)
+
+    def _sync(self):
+        with self._lock:
+            if self._synced:
+                return
+
+            started = time.monotonic()
+            on_disk = {}
+
+            if os.path.isdir(self.folder):
+                with os.scandir(self.folder) as it:
+                    for f in it:
+                        if f.is_file() and not f.name.endswith(_partial_suffixes):
+                            on_disk[f.name] = f.stat().st_size
+
+            indexed = dict(self._db.execute("SELECT name, size FROM files"))
+
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "DELETE FROM files WHERE name = ?",
+                    ((name,) for name in indexed.keys() - on_disk.keys()),
+                )
+                # a file that changed size is a different file, whatever we knew about it is wrong now
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO files (name, stem, base, size, added) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (name, *self._names(name), size, time.time())
+                        for name, size in on_disk.items()
+                        if indexed.get(name) != size
+                    ),
+                )
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+
+            self.size = sum(on_disk.values())
+            self._synced = True
+
+        log.debug(
+            "Synced audio cache index with {} files in {:.2f}s".format(
+                len(on_disk), time.monotonic() - started
+            )
+        )
+
+    def _lookup(self, column, value):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT name, size, duration, content_hash FROM files WHERE {} = ? LIMIT 1".format(
+                    column
+                ),
+                (value,),
+            ).fetchone()
+
+        if not row:
+            return None
+
+        if not os.path.isfile(os.path.join(self.folder, row[0])):
+            log.debug("Cached file {} is gone, dropping it".format(row[0]))
+            self.remove(row[0])
+            return None
+
+        return CachedFile(*row)
+
+    async def find(self, loop, name, *, generic=False):
+        """
+        Looks up the cached file a download of `name` would have produced.  Files of the generic extractor get
+        a content hash added to their name, so those are matched without it.  Other files are matched by their
+        exact name first and then without their extension, since the format that ends up downloaded can differ.
+        """
+        return await loop.run_in_executor(None, self._find, name, generic)
+
+    def _find(self, name, generic):
+        stem = name.rsplit(".", 1)[0]
+        if generic:
+            cached = self._lookup("base", stem)
+        else:
+            cached = self._lookup("name", name) or self._lookup("stem", stem)
+
+        if not cached:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        with self._lock:
+            self._db.execute(
+                "UPDATE files SET last_used = ?, hits = hits + 1 WHERE name = ?",
+                (time.time(), cached.name),
+            )
+
+        return cached
+
+    async def add(self, loop, filename, *, duration=None):
+        await loop.run_in_executor(None, self._add, filename, duration)
+
+    def _add(self, filename, duration):
+        name = os.path.basename(filename)
+        try:
+            size = os.path.getsize(os.path.join(self.folder, name))
+        except OSError:
+            log.debug("Not indexing missing file {}".format(name))
+            return
+
+        now = time.time()
+        with self._lock:
+            old = self._db.execute(
+                "SELECT size FROM files WHERE name = ?", (name,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (name, stem, base, size, duration, added, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, *self._names(name), size, duration, now, now),
+            )
+            self.size += size - (old[0] if old else 0)
+
+    async def update(self, loop, filename, *, duration=None):
+        await loop.run_in_executor(None, self._update, filename, duration)
+
+    def _update(self, filename, duration):
+        with self._lock:
+            self._db.execute(
+                "UPDATE files SET duration = COALESCE(?, duration) WHERE name = ?",
+                (duration, os.path.basename(filename)),
+            )
+
+    async def content_hash(self, loop, filename):
+        """
+        Returns the md5 of `filename`, hashing it in the executor the first time it's asked for.
+        """
+        name = os.path.basename(filename)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content_hash FROM files WHERE name = ?", (name,)
+            ).fetchone()
+
+        if row and row[0]:
+            return row[0]
+
+        content_hash = await loop.run_in_executor(
+            None, md5sum, os.path.join(self.folder, name)
+        )
+        with self._lock:
+            self._db.execute(
+                "UPDATE files SET content_hash = ? WHERE name = ?", (content_hash, name)
+            )
+
+        return content_hash
+
+    async def get_loudness(self, loop, filename):
+        """
+        Returns the loudness measured for a file with the same content as `filename` as a dict of
+        `LOUDNESS_FIELDS`, or None if it was never measured.
+        """
+        content_hash = await self.content_hash(loop, filename)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT {} FROM loudness WHERE hash = ?".format(", ".join(LOUDNESS_FIELDS)),
+                (content_hash,),
+            ).fetchone()
+
+        return dict(zip(LOUDNESS_FIELDS, row)) if row else None
+
+    async def set_loudness(self, loop, filename, loudness):
+        content_hash = await self.content_hash(loop, filename)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO loudness (hash, {}, measured) VALUES (?, ?, ?, ?, ?, ?, ?)".format(
+                    ", ".join(LOUDNESS_FIELDS)
+                ),
+                (
+                    content_hash,
+                    *(loudness[field] for field in LOUDNESS_FIELDS),
+                    time.time(),
+                ),
+            )
+
+    def remove(self, filename):
+        name = os.path.basename(filename)
+        with self._lock:
+            self._forget(name)
+
+    def _forget(self, name):
+        row = self._db.execute("SELECT size FROM files WHERE name = ?", (name,)).fetchone()
+        if row:
+            self._db.execute("DELETE FROM files WHERE name = ?", (name,))
+            self.size -= row[0]
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM files")
+            self.size = 0
+
+    def pin(self, filename):
+        """
+        Keeps `filename` from being deleted until it's unpinned as many times as it was pinned.
+        """
+        name = os.path.basename(filename)
+        self._pins[name] = self._pins.get(name, 0) + 1
+
+    def unpin(self, filename):
+        name = os.path.basename(filename)
+        count = self._pins.get(name, 0) - 1
+        if count > 0:
+            self._pins[name] = count
+        else:
+            self._pins.pop(name, None)
+
+    def is_pinned(self, filename):
+        return os.path.basename(filename) in self._pins
+
+    async def trim(self, loop):
+        """
+        Deletes the least recently played files that aren't pinned until the cache fits in `max_size` again.
+        """
+        if self.max_size and self.size > self.max_size:
+            await loop.run_in_executor(None, self._evict, frozenset(self._pins))
+
+    def _evict(self, pinned):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name FROM files ORDER BY COALESCE(last_used, added)"
+            ).fetchall()
+
+        # the files are deleted without holding the lock, so lookups don't have to wait for the disk
+        for (name,) in rows:
+            if self.size <= self.max_size:
+                break
+
+            if name in pinned:
+                continue
+
+            try:
+                os.unlink(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                log.debug("Could not evict {}".format(name), exc_info=True)
+                continue
+
+            self.remove(name)
+            self.evictions += 1
+            log.debug("Evicted {} from the audio cache".format(name))
+
+        if self.size > self.max_size:
+            log.warning(
+                "The audio cache is {:.1f} MB over its size limit, but everything in it is queued".format(
+                    (self.size - self.max_size) / 1024 / 1024
+                )
+            )
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "evictions": self.evictions,
+            "size": self.size,
+            "max_size": self.max_size,
+            "pinned": len(self._pins),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
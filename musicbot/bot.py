@@ -11,6 +11,7 @@ import pathlib
 import traceback
 import math
 import re
+import json
 
 import aiohttp
 import discord
@@ -28,7 +29,8 @@ from . import exceptions
 from . import downloader
 
 from .playlist import Playlist
-from .player import MusicPlayer
+from .journal import QueueJournal, JournalFlusher
+from .player import MusicPlayer, DecoderHub, StderrClassifier, StderrMultiplexer
 from .entry import StreamPlaylistEntry
 from .opus_loader import load_opus_lib
 from .config import Config, ConfigDefaults
@@ -100,7 +102,16 @@ class MusicBot(discord.Client):
         self.autoplaylist = load_file(self.config.auto_playlist_file)
 
         self.aiolocks = defaultdict(asyncio.Lock)
-        self.downloader = downloader.Downloader(download_folder="audio_cache")
+        self.downloader = downloader.Downloader(
+            download_folder="audio_cache",
+            cache_size=self.config.extraction_cache_size,
+            cache_ttl=self.config.extraction_cache_ttl,
+            metadata_threads=self.config.metadata_threads,
+            download_threads=self.config.download_threads,
+            prefetch_threads=self.config.prefetch_threads,
+            extraction_processes=self.config.extraction_processes,
+            audio_cache_size=self.config.audio_cache_size * 1024 * 1024,
+        )
 
         log.info("Starting MusicBot {}".format(BOTVERSION))
 
@@ -128,6 +139,16 @@ class MusicBot(discord.Client):
         self.aiosession = aiohttp.ClientSession(
             loop=self.loop, headers={"User-Agent": self.http.user_agent}
         )
+        self.stderr_reader = StderrMultiplexer(
+            self.loop,
+            StderrClassifier(self.config.ffmpeg_warnings, self.config.ffmpeg_errors),
+        )
+        self.decoder_hub = DecoderHub(self.stderr_reader)
+        self.queue_flusher = JournalFlusher(
+            self.loop,
+            delay=self.config.persistent_queue_delay,
+            max_changes=self.config.persistent_queue_batch,
+        )
 
         self.spotify = None
         if self.config._spotify:
@@ -226,6 +247,8 @@ class MusicBot(discord.Client):
         )
 
     def _delete_old_audiocache(self, path=AUDIO_CACHE_PATH):
+        self.downloader.audio_cache.invalidate()
+
         try:
             shutil.rmtree(path)
             return True
@@ -548,7 +571,6 @@ class MusicBot(discord.Client):
             .on("pause", self.on_player_pause)
             .on("stop", self.on_player_stop)
             .on("finished-playing", self.on_player_finished_playing)
-            .on("entry-added", self.on_player_entry_added)
             .on("error", self.on_player_error)
         )
 
@@ -557,6 +579,10 @@ class MusicBot(discord.Client):
         if guild:
             self.players[guild.id] = player
 
+            if self.config.persistent_queue:
+                journal = player.playlist.journal or self._queue_journal(guild)
+                journal.attach(player)
+
         return player
 
     async def on_player_play(self, player, entry):
@@ -564,9 +590,6 @@ class MusicBot(discord.Client):
         await self.update_now_playing_status(entry)
         player.skip_state.reset()
 
-        # This is the one event where its ok to serialize autoplaylist entries
-        await self.serialize_queue(player.voice_client.channel.guild)
-
         if self.config.write_current_song:
             await self.write_current_song(player.voice_client.channel.guild, entry)
 
@@ -707,7 +730,11 @@ class MusicBot(discord.Client):
 
                 try:
                     info = await self.downloader.extract_info(
-                        player.playlist.loop, song_url, download=False, process=False
+                        player.playlist.loop,
+                        song_url,
+                        download=False,
+                        process=False,
+                        prefetch=True,
                     )
                 except downloader.youtube_dl.utils.DownloadError as e:
                     if "YouTube said:" in e.args[0]:
@@ -762,17 +789,9 @@ class MusicBot(discord.Client):
                 log.warning("No playable songs in the autoplaylist, disabling.")
                 self.config.auto_playlist = False
 
-        else:  # Don't serialize for autoplaylist events
-            await self.serialize_queue(player.voice_client.channel.guild)
-
         if not player.is_stopped and not player.is_dead:
             player.play(_continue=True)
 
-    async def on_player_entry_added(self, player, playlist, entry, **_):
-        log.debug("Running on_player_entry_added")
-        if entry.meta.get("author") and entry.meta.get("channel"):
-            await self.serialize_queue(player.voice_client.channel.guild)
-
     async def on_player_error(self, player, entry, ex, **_):
         if "channel" in entry.meta:
             await self.safe_send_message(
@@ -843,21 +862,34 @@ class MusicBot(discord.Client):
 
         self.server_specific_data[guild]["last_np_msg"] = m
 
+    def _queue_journal(self, guild, path=None):
+        return QueueJournal(
+            path or "data/%s/queue.json" % guild.id,
+            fsync=self.config.persistent_queue_fsync,
+            compact_after=self.config.persistent_queue_compaction,
+            scheduler=self.queue_flusher,
+        )
+
     async def serialize_queue(self, guild, *, dir=None):
         """
-        Serialize the current queue for a server's player to json.
+        Serialize the current queue for a server's player to json.  If the queue is being journaled, this
+        compacts the journal into a new snapshot instead.
         """
 
         player = self.get_player_in(guild)
         if not player:
             return
 
-        if dir is None:
-            dir = "data/%s/queue.json" % guild.id
-
         async with self.aiolocks["queue_serialization" + ":" + str(guild.id)]:
             log.debug("Serializing queue for %s", guild.id)
 
+            if dir is None and player.playlist.journal:
+                await self.queue_flusher.flush(player.playlist.journal, compact=True)
+                return
+
+            if dir is None:
+                dir = "data/%s/queue.json" % guild.id
+
             with open(dir, "w", encoding="utf8") as f:
                 f.write(player.serialize(sort_keys=True))
 
@@ -865,6 +897,9 @@ class MusicBot(discord.Client):
         coros = [self.serialize_queue(s, dir=dir) for s in self.guilds]
         await asyncio.gather(*coros, return_exceptions=True)
 
+        # the queues of players that are gone can still have changes that weren't written yet
+        await self.queue_flusher.flush_all()
+
     async def deserialize_queue(
         self, guild, voice_client, playlist=None, *, dir=None
     ) -> MusicPlayer:
@@ -878,16 +913,18 @@ class MusicBot(discord.Client):
         if dir is None:
             dir = "data/%s/queue.json" % guild.id
 
-        async with self.aiolocks["queue_serialization" + ":" + str(guild.id)]:
-            if not os.path.isfile(dir):
-                return None
+        journal = self._queue_journal(guild, dir)
 
+        async with self.aiolocks["queue_serialization" + ":" + str(guild.id)]:
             log.debug("Deserializing queue for %s", guild.id)
+            data = await self.loop.run_in_executor(None, journal.load)
+            if data is None:
+                return None
 
-            with open(dir, "r", encoding="utf8") as f:
-                data = f.read()
-
-        return MusicPlayer.from_json(data, self, voice_client, playlist)
+        player = MusicPlayer.from_json(data, self, voice_client, playlist)
+        if player:
+            player.playlist.journal = journal
+        return player
 
     async def write_current_song(self, guild, entry, *, dir=None):
         """
@@ -929,7 +966,11 @@ class MusicBot(discord.Client):
             for guild in sorted(self.guilds, key=lambda s: int(s.id)):
                 f.write("{:<22} {}\n".format(guild.id, guild.name))
 
-        if not self.config.save_videos and os.path.isdir(AUDIO_CACHE_PATH):
+        if (
+            not self.config.save_videos
+            and not self.config.audio_cache_size
+            and os.path.isdir(AUDIO_CACHE_PATH)
+        ):
             if self._delete_old_audiocache():
                 log.debug("Deleted old audio cache")
             else:
@@ -1054,6 +1095,8 @@ class MusicBot(discord.Client):
         except:
             pass
 
+        self.downloader.shutdown()
+
         pending = asyncio.all_tasks()
         gathered = asyncio.gather(*pending)
 
@@ -1087,6 +1130,9 @@ class MusicBot(discord.Client):
                 raise self.exit_signal  # pylint: disable=E0702
 
     async def logout(self):
+        if self.config.persistent_queue:
+            await self.serialize_all_queues()
+
         await self.disconnect_all_voice_clients()
         return await super().close()
 
@@ -1859,16 +1905,20 @@ class MusicBot(discord.Client):
             info = await self.downloader.extract_info(
                 player.playlist.loop, song_url, download=False, process=False
             )
+            info_process = None
+            info_process_err = None
+
+            # Playlists get expanded later on, anything else is processed from the info we already have
+            # instead of being looked up again.
             # If there is an exception arise when processing we go on and let extract_info down the line report it
             # because info might be a playlist and thing that's broke it might be individual entry
-            try:
-                info_process = await self.downloader.extract_info(
-                    player.playlist.loop, song_url, download=False
-                )
-                info_process_err = None
-            except Exception as e:
-                info_process = None
-                info_process_err = e
+            if info and "entries" not in info:
+                try:
+                    info_process = await self.downloader.process_info(
+                        player.playlist.loop, info
+                    )
+                except Exception as e:
+                    info_process_err = e
 
             return (info, info_process, info_process_err)
 
@@ -1956,6 +2006,9 @@ class MusicBot(discord.Client):
                     expire_in=30,
                 )
 
+            # processed info for the entry we end up queueing, handed down so it isn't looked up again
+            entry_info = info_process
+
             # abstract the search handling away from the user
             # our ytdl options allow us to use search strings as input urls
             if info.get("url", "").startswith("ytsearch"):
@@ -1984,6 +2037,8 @@ class MusicBot(discord.Client):
                     song_url = info["entries"][0]["webpage_url"]
                     info = info["entries"][0]
 
+                entry_info = info
+
             # If it's playlist
             if "entries" in info:
                 await self._do_playlist_checks(
@@ -2061,7 +2116,7 @@ class MusicBot(discord.Client):
                 if permissions.max_song_length:
                     for e in entry_list.copy():
                         if e.duration > permissions.max_song_length:
-                            player.playlist.entries.remove(e)
+                            player.playlist.remove(e)
                             entry_list.remove(e)
                             drop_count += 1
                             # Im pretty sure there's no situation where this would ever break
@@ -2110,6 +2165,7 @@ class MusicBot(discord.Client):
                             download=False,
                             process=False,
                         )
+                        entry_info = None
                     except Exception as e:
                         raise exceptions.CommandError(e, expire_in=30)
 
@@ -2126,7 +2182,7 @@ class MusicBot(discord.Client):
                     )
 
                 entry, position = await player.playlist.add_entry(
-                    song_url, channel=channel, author=author, head=head
+                    song_url, channel=channel, author=author, head=head, info=entry_info
                 )
 
                 reply_text = self.str.get(
@@ -2187,11 +2243,34 @@ class MusicBot(discord.Client):
         )  # TODO: From playlist_title
         await self.send_typing(channel)
 
+        last_progress_update = time.time()
+
+        async def report_progress(processed, total):
+            nonlocal last_progress_update
+            if (
+                not busymsg
+                or processed == total
+                or time.time() - last_progress_update < 5
+            ):
+                return
+
+            last_progress_update = time.time()
+            await self.safe_edit_message(
+                busymsg,
+                self.str.get(
+                    "cmd-play-playlist-progress", "Processing {0} songs... ({1}/{0} done)"
+                ).format(total, processed),
+                quiet=True,
+            )
+
         entries_added = 0
         if extractor_type == "youtube:playlist":
             try:
                 entries_added = await player.playlist.async_process_youtube_playlist(
-                    playlist_url, channel=channel, author=author
+                    playlist_url,
+                    channel=channel,
+                    author=author,
+                    progress_callback=report_progress,
                 )
                 # TODO: Add hook to be called after each song
                 # TODO: Add permissions
@@ -2209,7 +2288,10 @@ class MusicBot(discord.Client):
         elif extractor_type.lower() in ["soundcloud:set", "bandcamp:album"]:
             try:
                 entries_added = await player.playlist.async_process_sc_bc_playlist(
-                    playlist_url, channel=channel, author=author
+                    playlist_url,
+                    channel=channel,
+                    author=author,
+                    progress_callback=report_progress,
                 )
                 # TODO: Add hook to be called after each song
                 # TODO: Add permissions
@@ -2232,7 +2314,7 @@ class MusicBot(discord.Client):
             for e in entries_added.copy():
                 if e.duration > permissions.max_song_length:
                     try:
-                        player.playlist.entries.remove(e)
+                        player.playlist.remove(e)
                         entries_added.remove(e)
                         drop_count += 1
                     except:
@@ -2258,7 +2340,8 @@ class MusicBot(discord.Client):
         songs_added = len(entries_added)
         tnow = time.time()
         ttime = tnow - t0
-        wait_per_song = 1.2
+        # songs are looked up PlaylistConcurrency at a time
+        wait_per_song = 1.2 / self.config.playlist_concurrency
         # TODO: actually calculate wait per song in the process function and return that too
 
         # This is technically inaccurate since bad songs are ignored but still take up time
@@ -2866,6 +2949,72 @@ class MusicBot(discord.Client):
                 self.str.get("cmd-resume-none", "Player is not paused."), expire_in=30
             )
 
+    async def cmd_seek(self, player, position):
+        """
+        Usage:
+            {command_prefix}seek [+/-][[hh:]mm:]ss
+
+        Jumps to a position in the current song.
+        Putting + or - before the position will jump forwards or backwards from where the song is now.
+        """
+
+        if not (player.is_playing or player.is_paused) or not player.current_entry:
+            raise exceptions.CommandError(
+                self.str.get("cmd-seek-none", "Player is not playing."), expire_in=30
+            )
+
+        if isinstance(player.current_entry, StreamPlaylistEntry):
+            raise exceptions.CommandError(
+                self.str.get("cmd-seek-stream", "Can't seek in a stream."),
+                expire_in=30,
+            )
+
+        relative = position[0] in "+-"
+        try:
+            parts = position.lstrip("+-").split(":")
+            if len(parts) > 3:
+                raise ValueError("too many fields")
+
+            seconds = 0
+            for i, part in enumerate(parts):
+                value = float(part)
+                # float() takes inf and nan too, and only the hours can go past 59
+                if not math.isfinite(value) or value < 0 or (i and value >= 60):
+                    raise ValueError("out of range")
+                seconds = seconds * 60 + value
+        except ValueError:
+            raise exceptions.CommandError(
+                self.str.get("cmd-seek-invalid", "`{0}` is not a valid position").format(
+                    position
+                ),
+                expire_in=20,
+            )
+
+        if relative:
+            seconds = player.progress + (seconds if position[0] == "+" else -seconds)
+
+        seconds = max(0, seconds)
+        duration = player.current_entry.duration
+        if duration and seconds >= duration:
+            raise exceptions.CommandError(
+                self.str.get(
+                    "cmd-seek-past-end", "`{0}` is past the end of the song ({1})."
+                ).format(
+                    ftimedelta(timedelta(seconds=seconds)),
+                    ftimedelta(timedelta(seconds=duration)),
+                ),
+                expire_in=20,
+            )
+
+        player.seek(seconds)
+
+        return Response(
+            self.str.get("cmd-seek-reply", "Jumped to `{0}` in **{1}**").format(
+                ftimedelta(timedelta(seconds=seconds)), player.current_entry.title
+            ),
+            delete_after=20,
+        )
+
     async def cmd_shuffle(self, channel, player):
         """
         Usage:
@@ -2936,13 +3085,9 @@ class MusicBot(discord.Client):
             for user in user_mentions:
                 if permissions.remove or author == user:
                     try:
-                        entry_indexes = [
-                            e
-                            for e in player.playlist.entries
-                            if e.meta.get("author", None) == user
-                        ]
+                        entry_indexes = player.playlist.entries_for_user(user)
                         for entry in entry_indexes:
-                            player.playlist.entries.remove(entry)
+                            player.playlist.remove(entry)
                         entry_text = "%s " % len(entry_indexes) + "item"
                         if len(entry_indexes) > 1:
                             entry_text += "s"
@@ -3738,6 +3883,10 @@ class MusicBot(discord.Client):
         if player and player.is_paused:
             player.resume()
 
+        if self.config.persistent_queue:
+            # save where every song is at before leaving the channels clears the queues
+            await self.serialize_all_queues()
+
         await self.disconnect_all_voice_clients()
         raise exceptions.RestartSignal()
 
@@ -3754,6 +3903,10 @@ class MusicBot(discord.Client):
         if player and player.is_paused:
             player.resume()
 
+        if self.config.persistent_queue:
+            # save where every song is at before leaving the channels clears the queues
+            await self.serialize_all_queues()
+
         await self.disconnect_all_voice_clients()
         raise exceptions.TerminateSignal()
 
@@ -3817,6 +3970,21 @@ class MusicBot(discord.Client):
 
         return Response(data, codeblock="py")
 
+    @dev_only
+    async def cmd_downloaderstats(self):
+        return Response(
+            json.dumps(
+                dict(
+                    self.downloader.stats,
+                    decoders=self.decoder_hub.stats,
+                    stderr=self.stderr_reader.stats,
+                ),
+                indent=4,
+                sort_keys=True,
+            ),
+            codeblock="json",
+        )
+
     @dev_only
     async def cmd_debug(self, message, _player, *, data):
         codeblock = "```py\n{}\n```"
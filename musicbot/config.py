@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import codecs
 import shutil
@@ -128,6 +129,26 @@ class Config:
         self.persistent_queue = config.getboolean(
             "MusicBot", "PersistentQueue", fallback=ConfigDefaults.persistent_queue
         )
+        self.persistent_queue_delay = config.getfloat(
+            "MusicBot",
+            "PersistentQueueDelay",
+            fallback=ConfigDefaults.persistent_queue_delay,
+        )
+        self.persistent_queue_batch = config.getint(
+            "MusicBot",
+            "PersistentQueueBatch",
+            fallback=ConfigDefaults.persistent_queue_batch,
+        )
+        self.persistent_queue_fsync = config.getboolean(
+            "MusicBot",
+            "PersistentQueueFsync",
+            fallback=ConfigDefaults.persistent_queue_fsync,
+        )
+        self.persistent_queue_compaction = config.getint(
+            "MusicBot",
+            "PersistentQueueCompaction",
+            fallback=ConfigDefaults.persistent_queue_compaction,
+        )
         self.status_message = config.get(
             "MusicBot", "StatusMessage", fallback=ConfigDefaults.status_message
         )
@@ -142,6 +163,28 @@ class Config:
             "UseExperimentalEqualization",
             fallback=ConfigDefaults.use_experimental_equalization,
         )
+        self.deferred_equalization = config.getboolean(
+            "MusicBot",
+            "DeferredEqualization",
+            fallback=ConfigDefaults.deferred_equalization,
+        )
+        self.progressive_playback = config.getboolean(
+            "MusicBot",
+            "ProgressivePlayback",
+            fallback=ConfigDefaults.progressive_playback,
+        )
+        self.opus_passthrough = config.getboolean(
+            "MusicBot", "OpusPassthrough", fallback=ConfigDefaults.opus_passthrough
+        )
+        self.share_decoding = config.getboolean(
+            "MusicBot", "ShareDecoding", fallback=ConfigDefaults.share_decoding
+        )
+        self.gapless_playback = config.getboolean(
+            "MusicBot", "GaplessPlayback", fallback=ConfigDefaults.gapless_playback
+        )
+        self.crossfade = config.getint(
+            "MusicBot", "Crossfade", fallback=ConfigDefaults.crossfade
+        )
         self.embeds = config.getboolean(
             "MusicBot", "UseEmbeds", fallback=ConfigDefaults.embeds
         )
@@ -178,6 +221,52 @@ class Config:
             "DefaultSearchResults",
             fallback=ConfigDefaults.defaultsearchresults,
         )
+        self.playlist_concurrency = config.getint(
+            "MusicBot",
+            "PlaylistConcurrency",
+            fallback=ConfigDefaults.playlist_concurrency,
+        )
+        self.prefetch_songs = config.getint(
+            "MusicBot", "PrefetchSongs", fallback=ConfigDefaults.prefetch_songs
+        )
+        self.prefetch_size_limit = config.getint(
+            "MusicBot",
+            "PrefetchSizeLimit",
+            fallback=ConfigDefaults.prefetch_size_limit,
+        )
+        self.audio_cache_size = config.getint(
+            "MusicBot", "AudioCacheSize", fallback=ConfigDefaults.audio_cache_size
+        )
+        self.extraction_cache_size = config.getint(
+            "MusicBot",
+            "ExtractionCacheSize",
+            fallback=ConfigDefaults.extraction_cache_size,
+        )
+        self.extraction_cache_ttl = config.getint(
+            "MusicBot",
+            "ExtractionCacheTTL",
+            fallback=ConfigDefaults.extraction_cache_ttl,
+        )
+        self.metadata_threads = config.getint(
+            "MusicBot", "MetadataThreads", fallback=ConfigDefaults.metadata_threads
+        )
+        self.download_threads = config.getint(
+            "MusicBot", "DownloadThreads", fallback=ConfigDefaults.download_threads
+        )
+        self.prefetch_threads = config.getint(
+            "MusicBot", "PrefetchThreads", fallback=ConfigDefaults.prefetch_threads
+        )
+        self.extraction_processes = config.getint(
+            "MusicBot",
+            "ExtractionProcesses",
+            fallback=ConfigDefaults.extraction_processes,
+        )
+        self.ffmpeg_warnings = config.get(
+            "MusicBot", "FFmpegWarnings", fallback=ConfigDefaults.ffmpeg_warnings
+        )
+        self.ffmpeg_errors = config.get(
+            "MusicBot", "FFmpegErrors", fallback=ConfigDefaults.ffmpeg_errors
+        )
 
         self.debug_level = config.get(
             "MusicBot", "DebugLevel", fallback=ConfigDefaults.debug_level
@@ -364,6 +453,119 @@ class Config:
         if not self.footer_text:
             self.footer_text = ConfigDefaults.footer_text
 
+        if self.playlist_concurrency < 1:
+            log.warning(
+                "PlaylistConcurrency must be at least 1, falling back to {}".format(
+                    ConfigDefaults.playlist_concurrency
+                )
+            )
+            self.playlist_concurrency = ConfigDefaults.playlist_concurrency
+
+        if self.persistent_queue_delay < 0:
+            log.warning(
+                "PersistentQueueDelay must not be negative, falling back to {}".format(
+                    ConfigDefaults.persistent_queue_delay
+                )
+            )
+            self.persistent_queue_delay = ConfigDefaults.persistent_queue_delay
+
+        if self.persistent_queue_batch < 1:
+            log.warning(
+                "PersistentQueueBatch must be at least 1, falling back to {}".format(
+                    ConfigDefaults.persistent_queue_batch
+                )
+            )
+            self.persistent_queue_batch = ConfigDefaults.persistent_queue_batch
+
+        if self.persistent_queue_compaction < 1:
+            log.warning(
+                "PersistentQueueCompaction must be at least 1, falling back to {}".format(
+                    ConfigDefaults.persistent_queue_compaction
+                )
+            )
+            self.persistent_queue_compaction = ConfigDefaults.persistent_queue_compaction
+
+        if self.prefetch_songs < 0:
+            log.warning(
+                "PrefetchSongs must not be negative, falling back to {}".format(
+                    ConfigDefaults.prefetch_songs
+                )
+            )
+            self.prefetch_songs = ConfigDefaults.prefetch_songs
+
+        if self.prefetch_size_limit < 0:
+            log.warning(
+                "PrefetchSizeLimit must not be negative, falling back to {}".format(
+                    ConfigDefaults.prefetch_size_limit
+                )
+            )
+            self.prefetch_size_limit = ConfigDefaults.prefetch_size_limit
+
+        if self.audio_cache_size < 0:
+            log.warning("AudioCacheSize must not be negative, turning the cache off")
+            self.audio_cache_size = 0
+
+        if self.extraction_cache_size < 0:
+            log.warning(
+                "ExtractionCacheSize must not be negative, disabling the extraction cache"
+            )
+            self.extraction_cache_size = 0
+
+        if self.extraction_cache_ttl < 0:
+            log.warning(
+                "ExtractionCacheTTL must not be negative, falling back to {}".format(
+                    ConfigDefaults.extraction_cache_ttl
+                )
+            )
+            self.extraction_cache_ttl = ConfigDefaults.extraction_cache_ttl
+
+        for attr, option in (
+            ("metadata_threads", "MetadataThreads"),
+            ("download_threads", "DownloadThreads"),
+            ("prefetch_threads", "PrefetchThreads"),
+        ):
+            if getattr(self, attr) < 1:
+                log.warning(
+                    "{} must be at least 1, falling back to {}".format(
+                        option, getattr(ConfigDefaults, attr)
+                    )
+                )
+                setattr(self, attr, getattr(ConfigDefaults, attr))
+
+        if self.extraction_processes < 0:
+            log.warning(
+                "ExtractionProcesses must not be negative, extracting in threads instead"
+            )
+            self.extraction_processes = 0
+
+        if not 0 <= self.crossfade <= 30000:
+            log.warning(
+                "Crossfade must be between 0 and 30000 milliseconds, falling back to {}".format(
+                    ConfigDefaults.crossfade
+                )
+            )
+            self.crossfade = ConfigDefaults.crossfade
+
+        for attr, option in (
+            ("ffmpeg_warnings", "FFmpegWarnings"),
+            ("ffmpeg_errors", "FFmpegErrors"),
+        ):
+            patterns = []
+            for pattern in getattr(self, attr).splitlines():
+                pattern = pattern.strip()
+                if not pattern:
+                    continue
+                try:
+                    # compiled the same way the ffmpeg output is matched with, as bytes
+                    re.compile(pattern.encode("utf8"))
+                except re.error as e:
+                    log.warning(
+                        'Ignoring invalid {} pattern "{}": {}'.format(option, pattern, e)
+                    )
+                    continue
+                patterns.append(pattern)
+            setattr(self, attr, patterns)
+
     def create_empty_file_ifnoexist(self, path):
         if not os.path.isfile(path):
             open(path, "a").close()
@@ -497,11 +699,21 @@ class ConfigDefaults:
     delete_messages = True
     delete_invoking = False
     persistent_queue = True
+    persistent_queue_delay = 5.0
+    persistent_queue_batch = 50
+    persistent_queue_fsync = False
+    persistent_queue_compaction = 200
     debug_level = "INFO"
     status_message = None
     write_current_song = False
     allow_author_skip = True
     use_experimental_equalization = False
+    deferred_equalization = False
+    progressive_playback = False
+    opus_passthrough = False
+    share_decoding = False
+    gapless_playback = False
+    crossfade = 0
     embeds = True
     queue_length = 10
     remove_ap = True
@@ -511,6 +723,18 @@ class ConfigDefaults:
     usealias = True
     searchlist = False
     defaultsearchresults = 3
+    playlist_concurrency = 4
+    prefetch_songs = 2
+    prefetch_size_limit = 100
+    audio_cache_size = 0
+    extraction_cache_size = 500
+    extraction_cache_ttl = 3600
+    metadata_threads = 2
+    download_threads = 2
+    prefetch_threads = 1
+    extraction_processes = 0
+    ffmpeg_warnings = ""
+    ffmpeg_errors = ""
     footer_text = "Just-Some-Bots/MusicBot ({})".format(BOTVERSION)
 
     options_file = "config/options.ini"
@@ -11,4 +11,6 @@ except Exception:
     VERSION = "version_unknown"
 
 AUDIO_CACHE_PATH = os.path.join(os.getcwd(), "audio_cache")
+AUDIO_CACHE_INDEX_PATH = os.path.join(os.getcwd(), "data", "audio_cache.sqlite")
+EXTRACTION_CACHE_PATH = os.path.join(os.getcwd(), "data", "extraction_cache.sqlite")
 DISCORD_MSG_CHAR_LIMIT = 2000
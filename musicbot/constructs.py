@@ -1,12 +1,12 @@
 import json
-import pydoc
 import inspect
 import logging
+import functools
 
 import discord
 
 from enum import Enum
-from .utils import objdiff, _get_variable
+from .utils import objdiff
 
 log = logging.getLogger(__name__)
 
@@ -73,38 +73,47 @@ class Serializer(json.JSONEncoder):
         return super().default(o)
 
     @classmethod
-    def deserialize(cls, data):
+    def deserialize(cls, data, context=None):
+        """
+        Object hook that turns serialized objects back into the class they came from.  Their `_deserialize` gets
+        the arguments it takes from `context`.
+        """
         if all(x in data for x in Serializable._class_signature):
-            # log.debug("Deserialization requested for %s", data)
-            factory = pydoc.locate(data["__module__"] + "." + data["__class__"])
-            # log.debug("Found object %s", factory)
-            if factory and issubclass(factory, Serializable):
-                # log.debug("Deserializing %s object", factory)
+            factory = Serializable._registry.get((data["__module__"], data["__class__"]))
+            if factory:
+                context = context or {}
                 return factory._deserialize(
-                    data["data"], **cls._get_vars(factory._deserialize)
+                    data["data"],
+                    **{name: context.get(name) for name in factory._context_args}
                 )
 
         return data
 
     @classmethod
-    def _get_vars(cls, func):
-        # log.debug("Getting vars for %s", func)
-        params = inspect.signature(func).parameters.copy()
-        args = {}
-        # log.debug("Got %s", params)
-
-        for name, param in params.items():
-            # log.debug("Checking arg %s, type %s", name, param.kind)
-            if param.kind is param.POSITIONAL_OR_KEYWORD and param.default is None:
-                # log.debug("Using var %s", name)
-                args[name] = _get_variable(name)
-                # log.debug("Collected var for arg '%s': %s", name, args[name])
-
-        return args
+    def loads(cls, raw_json, **context):
+        """
+        Deserializes `raw_json`, handing the objects in it whatever they need from `context`, such as the bot.
+        """
+        return json.loads(
+            raw_json, object_hook=functools.partial(cls.deserialize, context=context)
+        )
 
 
 class Serializable:
     _class_signature = ("__class__", "__module__", "data")
+    _registry = {}  # (module, qualname) -> class, for Serializer.deserialize
+    _context_args = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Serializable._registry[(cls.__module__, cls.__qualname__)] = cls
+
+        # the arguments of _deserialize that default to None come from the context it's deserialized with
+        cls._context_args = tuple(
+            name
+            for name, param in inspect.signature(cls._deserialize).parameters.items()
+            if param.kind is param.POSITIONAL_OR_KEYWORD and param.default is None
+        )
 
     def _enclose_json(self, data):
         return {
@@ -1,10 +1,22 @@
 import os
+import json
+import time
+import pickle
+import signal
+import sqlite3
 import asyncio
 import logging
 import functools
+import threading
 import yt_dlp as youtube_dl
 
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+from multiprocessing import get_context
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+from .audiocache import AudioCache
+from .constants import EXTRACTION_CACHE_PATH, AUDIO_CACHE_INDEX_PATH
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +35,15 @@ ytdl_format_options = {
     "usenetrc": True,
 }
 
+# Seconds that extracted info stays fresh for specific extractors, overriding the configured TTL.
+# A TTL of 0 means results from that extractor are never cached.
+extractor_cache_ttl = {
+    "generic": 600,
+    "dropbox": 600,
+    "twitch:stream": 0,
+    "twitch:vod": 1800,
+}
+
 # Fuck your useless bugreports message that gets two link embeds and confuses users
 youtube_dl.utils.bug_reports_message = lambda: ""
 
@@ -35,10 +56,388 @@ youtube_dl.utils.bug_reports_message = lambda: ""
 """
 
 
+# The warm ytdl objects of an extraction worker process, keyed by whether they ignore errors.
+_worker_ytdl = {}
+
+
+def _init_extraction_worker(options):
+    # ctrl+c reaches the whole process group, let the bot decide when the workers go away
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    _worker_ytdl[False] = youtube_dl.YoutubeDL(options)
+    _worker_ytdl[True] = youtube_dl.YoutubeDL({**options, "ignoreerrors": True})
+
+
+def _picklable(info):
+    # unprocessed playlists hand out their entries lazily, that doesn't survive the trip back to the bot
+    if info and "entries" in info and not isinstance(info["entries"], list):
+        info["entries"] = list(info["entries"])
+
+    return info
+
+
+def _run_in_worker(safe, method, *args, **kwargs):
+    try:
+        return _picklable(getattr(_worker_ytdl[safe], method)(*args, **kwargs))
+
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            # the bot only looks at the type of the original error, tracebacks can't be pickled
+            if isinstance(e, youtube_dl.utils.DownloadError) and e.exc_info:
+                e.exc_info = (e.exc_info[0], None, None)
+            else:
+                e = youtube_dl.utils.DownloadError(str(e))
+            e.__traceback__ = None
+            e.__cause__ = e.__context__ = None
+
+        raise e
+
+
+class ExtractionCache:
+    """
+    Caches the info dicts of metadata-only extractions, keyed by the normalized url or search query,
+    the `process` flag and which ytdl object ran it.  Recently used results are kept in memory, everything
+    else lives in a sqlite file so results survive restarts.  Info is stored as json so every lookup hands
+    out a fresh copy that callers are free to mutate.
+    """
+
+    def __init__(self, path=None, *, max_size=500, ttl=3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path:
+            self._open_db()
+
+    def _open_db(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, expires REAL NOT NULL, data TEXT NOT NULL)"
+            )
+            self._db.execute("DELETE FROM info WHERE expires < ?", (time.time(),))
+        except sqlite3.Error:
+            log.warning(
+                "Could not open extraction cache {}, caching in memory only".format(
+                    self.path
+                ),
+                exc_info=True,
+            )
+            self._db = None
+
+    @staticmethod
+    def make_key(url, process=True, safe=False):
+        url = url.strip().strip("<>")
+        parts = urlsplit(url)
+        if parts.scheme and parts.netloc:
+            # scheme and host are case insensitive and the fragment never reaches the server
+            url = urlunsplit(
+                (parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, "")
+            )
+
+        return "{:d}:{:d}:{}".format(bool(process), bool(safe), url)
+
+    def ttl_for(self, info):
+        if info.get("is_live"):
+            return 0
+
+        extractor = (info.get("extractor") or "").lower()
+        return extractor_cache_ttl.get(extractor, self.ttl)
+
+    def get(self, key):
+        """
+        Looks up `key` in the memory tier only, this is cheap enough to do on the event loop.
+        """
+        with self._lock:
+            cached = self._memory.get(key)
+            if not cached:
+                return None
+
+            expires, data = cached
+            if expires < time.time():
+                del self._memory[key]
+                return None
+
+            self._memory.move_to_end(key)
+            self.hits += 1
+
+        return json.loads(data)
+
+    def load(self, key):
+        """
+        Looks up `key` in memory and then on disk, promoting disk hits into memory.  Counts a miss if
+        neither tier has it.  This hits the disk so it should be run in the executor.
+        """
+        info = self.get(key)
+        if info is not None:
+            return info
+
+        row = None
+        if self._db:
+            with self._lock:
+                try:
+                    row = self._db.execute(
+                        "SELECT expires, data FROM info WHERE key = ? AND expires >= ?",
+                        (key, time.time()),
+                    ).fetchone()
+                except sqlite3.Error:
+                    log.debug("Error reading extraction cache", exc_info=True)
+
+        if not row:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, *row)
+
+        return json.loads(row[1])
+
+    def put(self, key, info):
+        ttl = self.ttl_for(info)
+        if ttl <= 0:
+            return
+
+        try:
+            data = json.dumps(info)
+        except (TypeError, ValueError):
+            # unprocessed playlists hold generators for their entries, we can't keep those around
+            log.noise("Not caching unserializable info for {}".format(key))
+            return
+
+        expires = time.time() + ttl
+        with self._lock:
+            self._remember(key, expires, data)
+
+            if self._db:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO info (key, expires, data) VALUES (?, ?, ?)",
+                        (key, expires, data),
+                    )
+                except sqlite3.Error:
+                    log.debug("Error writing extraction cache", exc_info=True)
+
+    def _remember(self, key, expires, data):
+        self._memory[key] = (expires, data)
+        self._memory.move_to_end(key)
+
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0,
+            "memory_size": len(self._memory),
+        }
+
+
+class MonitoredThreadPool(ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor that keeps track of how many jobs are waiting for a thread and how long they waited,
+    so a pool that is too small for its workload shows up in the stats instead of as a slow bot.
+    """
+
+    def __init__(self, name, max_workers):
+        super().__init__(
+            max_workers=max_workers, thread_name_prefix="downloader-" + name
+        )
+        self.name = name
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self._stats_lock = threading.Lock()
+        self._pending = set()
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted = time.monotonic()
+
+        def run():
+            waited = time.monotonic() - submitted
+            with self._stats_lock:
+                self.queued -= 1
+                self.running += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+
+            if waited > 5:
+                log.debug(
+                    "Job waited {:.1f}s for a thread in the {} pool".format(
+                        waited, self.name
+                    )
+                )
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        with self._stats_lock:
+            self.queued += 1
+
+        future = super().submit(run)
+        with self._stats_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self._stats_lock:
+            self._pending.discard(future)
+
+            # jobs cancelled before they got a thread never run, so they never leave the queue on their own
+            if future.cancelled():
+                self.queued -= 1
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        # cancel_futures only exists from python 3.9 on, so the jobs that haven't started are cancelled here
+        if cancel_futures:
+            with self._stats_lock:
+                pending = list(self._pending)
+
+            for future in pending:
+                future.cancel()
+
+        super().shutdown(wait=wait)
+
+    @property
+    def stats(self):
+        with self._stats_lock:
+            started = self.completed + self.running
+            return {
+                "workers": self._max_workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "avg_wait": self.total_wait / started if started else 0,
+                "max_wait": self.max_wait,
+            }
+
+
+class _PrefetchJob:
+    """
+    A job waiting in the prefetch pool that can also be handed to the download pool.  Whichever pool gets a
+    thread to it first runs it, the other one finds it taken and skips it.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.future = Future()
+        self._claimed = False
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            if self._claimed:
+                return
+            self._claimed = True
+
+        if not self.future.set_running_or_notify_cancel():
+            return  # cancelled
+
+        try:
+            self.future.set_result(self.fn())
+        except BaseException as e:
+            self.future.set_exception(e)
+
+
+class PrefetchTicket:
+    """
+    Passed as `prefetch` instead of True for background work that something might start waiting on before it's
+    done, like the download of a song that moves up to the front of the queue.  `promote` moves the jobs that
+    haven't got a prefetch thread yet to the download pool, and sends any later ones there to begin with.  A
+    ticket that starts out `promoted` doesn't prefetch at all.
+
+    `downloads` are the pool futures of the downloads submitted with the ticket, a running download can't be
+    stopped, so whoever gives up on it has to deal with the file it leaves behind.
+    """
+
+    def __init__(self, *, promoted=False):
+        self.promoted = promoted
+        self.downloads = []
+        self._jobs = []
+        self._pool = None
+
+    def add(self, job, pool):
+        self._jobs = [job for job in self._jobs if not job.future.done()]
+        self._jobs.append(job)
+        self._pool = pool
+
+    def promote(self):
+        if self.promoted:
+            return
+
+        self.promoted = True
+        for job in self._jobs:
+            if not job.future.running() and not job.future.done():
+                self._pool.submit(job.run)
+        self._jobs = []
+
+
 class Downloader:
-    def __init__(self, download_folder=None):
-        self.thread_pool = ThreadPoolExecutor(max_workers=2)
+    def __init__(
+        self,
+        download_folder=None,
+        *,
+        cache_size=500,
+        cache_ttl=3600,
+        cache_file=EXTRACTION_CACHE_PATH,
+        audio_cache_index=AUDIO_CACHE_INDEX_PATH,
+        audio_cache_size=0,
+        metadata_threads=2,
+        download_threads=2,
+        prefetch_threads=1,
+        extraction_processes=0
+    ):
+        # Metadata lookups answer commands and must not queue behind downloads, and background prefetching
+        # must not hold up the download of the song that's about to play.
+        self.metadata_pool = MonitoredThreadPool("metadata", metadata_threads)
+        self.download_pool = MonitoredThreadPool("download", download_threads)
+        self.prefetch_pool = MonitoredThreadPool("prefetch", prefetch_threads)
+
         self.download_folder = download_folder
+        self.cache = (
+            ExtractionCache(cache_file, max_size=cache_size, ttl=cache_ttl)
+            if cache_size > 0
+            else None
+        )
+
+        self.audio_cache = (
+            AudioCache(download_folder, audio_cache_index, max_size=audio_cache_size)
+            if download_folder
+            else None
+        )
 
         if download_folder:
             # print("setting template to " + os.path.join(download_folder, otmpl))
@@ -50,23 +449,93 @@ class Downloader:
             {**ytdl_format_options, "ignoreerrors": True}
         )
 
+        # Metadata extraction is mostly pure python and holds the GIL, which the voice threads and the
+        # event loop need.  Worker processes keep it off this interpreter, the metadata threads just wait
+        # on them so pool sizes and stats keep working the same way.
+        self.process_pool = None
+        self._worker_futures = set()
+        self._worker_lock = threading.Lock()
+        if extraction_processes > 0:
+            self.process_pool = ProcessPoolExecutor(
+                max_workers=extraction_processes,
+                mp_context=get_context("spawn"),
+                initializer=_init_extraction_worker,
+                initargs=(dict(ytdl_format_options),),
+            )
+
     @property
     def ytdl(self):
         return self.safe_ytdl
 
+    @property
+    def pools(self):
+        return self.metadata_pool, self.download_pool, self.prefetch_pool
+
+    @property
+    def stats(self):
+        return {
+            "pools": {pool.name: pool.stats for pool in self.pools},
+            "cache": self.cache.stats if self.cache else None,
+            "audio_cache": self.audio_cache.stats if self.audio_cache else None,
+            "extraction_processes": self.process_pool._max_workers
+            if self.process_pool
+            else 0,
+        }
+
+    def shutdown(self):
+        for pool in self.pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        if self.process_pool:
+            with self._worker_lock:
+                pending = list(self._worker_futures)
+
+            for future in pending:
+                future.cancel()
+            self.process_pool.shutdown(wait=False)
+
+        if self.cache:
+            self.cache.close()
+
+        if self.audio_cache:
+            self.audio_cache.close()
+
+    def _pool_for(self, download=True, prefetch=False):
+        if prefetch and not getattr(prefetch, "promoted", False):
+            return self.prefetch_pool
+
+        return self.download_pool if download else self.metadata_pool
+
+    def _submit(self, loop, fn, *, download=True, prefetch=False):
+        pool = self._pool_for(download, prefetch)
+        if not isinstance(prefetch, PrefetchTicket):
+            return loop.run_in_executor(pool, fn)
+
+        if pool is self.prefetch_pool:
+            job = _PrefetchJob(fn)
+            pool.submit(job.run)
+            prefetch.add(job, self.download_pool if download else self.metadata_pool)
+            future = job.future
+        else:
+            future = pool.submit(fn)
+
+        if download:
+            prefetch.downloads.append(future)
+        return asyncio.wrap_future(future, loop=loop)
+
     async def extract_info(
-        self, loop, *args, on_error=None, retry_on_error=False, **kwargs
+        self, loop, *args, on_error=None, retry_on_error=False, prefetch=False, **kwargs
     ):
         """
         Runs ytdl.extract_info within the threadpool. Returns a future that will fire when it's done.
         If `on_error` is passed and an exception is raised, the exception will be caught and passed to
-        on_error as an argument.
+        on_error as an argument.  Pass `prefetch` for background work nobody is waiting on yet, so it
+        runs in its own pool instead of competing with commands and playback.
         """
         if callable(on_error):
             try:
-                return await loop.run_in_executor(
-                    self.thread_pool,
-                    functools.partial(self.unsafe_ytdl.extract_info, *args, **kwargs),
+                return await self._extract(
+                    loop, self.unsafe_ytdl, *args, prefetch=prefetch, **kwargs
                 )
 
             except Exception as e:
@@ -83,15 +552,112 @@ class Downloader:
                     loop.call_soon_threadsafe(on_error, e)
 
                 if retry_on_error:
-                    return await self.safe_extract_info(loop, *args, **kwargs)
+                    return await self.safe_extract_info(
+                        loop, *args, prefetch=prefetch, **kwargs
+                    )
         else:
-            return await loop.run_in_executor(
-                self.thread_pool,
-                functools.partial(self.unsafe_ytdl.extract_info, *args, **kwargs),
+            return await self._extract(
+                loop, self.unsafe_ytdl, *args, prefetch=prefetch, **kwargs
+            )
+
+    async def process_info(self, loop, info, *, download=False, prefetch=False):
+        """
+        Finishes processing `info` from an extraction run with `process=False`, so a caller that needs both
+        the unprocessed and processed info only pays for one lookup.  Videos just get their formats picked,
+        url results still have to be resolved and go through `extract_info` (and the cache).
+        """
+        if info.get("_type", "video") == "url":
+            return await self.extract_info(
+                loop,
+                info["url"],
+                download=download,
+                prefetch=prefetch,
+                ie_key=info.get("ie_key"),
+            )
+
+        return await self._submit(
+            loop,
+            functools.partial(
+                self._run,
+                self.unsafe_ytdl,
+                "process_ie_result",
+                dict(info),
+                download=download,
+            ),
+            download=download,
+            prefetch=prefetch,
+        )
+
+    async def safe_extract_info(self, loop, *args, prefetch=False, **kwargs):
+        return await self._extract(
+            loop, self.safe_ytdl, *args, prefetch=prefetch, **kwargs
+        )
+
+    async def _extract(self, loop, ytdl, *args, prefetch=False, **kwargs):
+        """
+        Runs `ytdl.extract_info` in the pool for its workload, answering metadata-only requests from the cache
+        when possible.
+        """
+        download = kwargs.get("download", True)
+
+        if not self.cache or not args or download:
+            return await self._submit(
+                loop,
+                functools.partial(self._run, ytdl, "extract_info", *args, **kwargs),
+                download=download,
+                prefetch=prefetch,
             )
 
-    async def safe_extract_info(self, loop, *args, **kwargs):
-        return await loop.run_in_executor(
-            self.thread_pool,
-            functools.partial(self.safe_ytdl.extract_info, *args, **kwargs),
+        key = self.cache.make_key(
+            args[0], kwargs.get("process", True), ytdl is self.safe_ytdl
+        )
+
+        info = self.cache.get(key)
+        if info is not None:
+            log.noise("Extraction cache hit for {}".format(key))
+            return info
+
+        return await self._submit(
+            loop,
+            functools.partial(self._cached_extract, ytdl, key, *args, **kwargs),
+            download=download,
+            prefetch=prefetch,
         )
+
+    def _cached_extract(self, ytdl, key, *args, **kwargs):
+        info = self.cache.load(key)
+        if info is not None:
+            return info
+
+        info = self._run(ytdl, "extract_info", *args, **kwargs)
+        if info:
+            self.cache.put(key, info)
+
+        return info
+
+    def _run(self, ytdl, method, *args, **kwargs):
+        """
+        Calls `method` on `ytdl`, or on its twin in a worker process when extraction processes are enabled.
+        Downloads always run here, the worker processes only take over metadata work.
+        """
+        if not self.process_pool or kwargs.get("download", True):
+            info = getattr(ytdl, method)(*args, **kwargs)
+
+        else:
+            future = self.process_pool.submit(
+                _run_in_worker, ytdl is self.safe_ytdl, method, *args, **kwargs
+            )
+            with self._worker_lock:
+                self._worker_futures.add(future)
+            future.add_done_callback(self._worker_done)
+            info = future.result()
+
+        if isinstance(info, dict):
+            # when the media urls in it were looked up, processing info again or caching it keeps the original time
+            info.setdefault("_extracted", time.time())
+
+        return info
+
+    def _worker_done(self, future):
+        with self._worker_lock:
+            self._worker_futures.discard(future)
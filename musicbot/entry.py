@@ -1,4 +1,6 @@
 import os
+import time
+import shlex
 import asyncio
 import logging
 import traceback
@@ -7,6 +9,8 @@ import sys
 
 from enum import Enum
 from .constructs import Serializable
+from .audiocache import LOUDNESS_FIELDS
+from .downloader import PrefetchTicket
 from .exceptions import ExtractionError
 from .utils import get_header, md5sum
 
@@ -18,6 +22,9 @@ except:
 
 log = logging.getLogger(__name__)
 
+# Media urls handed out by sites expire, don't stream from ones older than this many seconds
+STREAM_URL_TTL = 1800
+
 
 class EntryTypes(Enum):
     URL = 1
@@ -33,6 +40,14 @@ class BasePlaylistEntry(Serializable):
         self.filename = None
         self._is_downloading = False
         self._waiting_futures = []
+        self._download_task = None
+        self._prefetch_ticket = None
+        # a download that was still running when it was cancelled, see `_abandon_download`
+        self._abandoned_download = None
+        # volume multiplier the player applies on top of its own volume, for equalization
+        self.gain = 1.0
+        # set while the entry can already be played from this url, even though it's still downloading
+        self.playback_url = None
 
     @property
     def is_downloaded(self):
@@ -41,23 +56,112 @@ class BasePlaylistEntry(Serializable):
 
         return bool(self.filename)
 
-    async def _download(self):
+    @property
+    def estimated_size(self):
+        """
+        Roughly how many bytes downloading this entry will take up.
+        """
+        return 0
+
+    def pin(self):
+        """
+        Keeps the downloaded file from being deleted while the entry is queued or playing.
+        """
+        pass
+
+    def unpin(self):
+        pass
+
+    async def _download(self, *, prefetch=False):
         raise NotImplementedError
 
-    def get_ready_future(self):
+    def _start_download(self, prefetch):
+        if self._download_task and not self._download_task.done():
+            if not prefetch and self._prefetch_ticket:
+                # it's needed now, so it shouldn't wait behind other background work anymore
+                self._prefetch_ticket.promote()
+            return
+
+        # downloads that aren't prefetches get a ticket too, it keeps track of them in case they're cancelled
+        self._prefetch_ticket = PrefetchTicket(promoted=not prefetch)
+        self._download_task = asyncio.ensure_future(
+            self._download(prefetch=self._prefetch_ticket)
+        )
+
+    def prefetch(self, *, lookahead=True):
+        """
+        Starts downloading the entry in the background if it isn't downloaded yet.  Without `lookahead` it's the
+        next entry to play, which is downloaded in the download pool instead of the prefetch pool.
+        """
+        if not self.is_downloaded:
+            self._start_download(lookahead)
+
+    def cancel_prefetch(self):
+        """
+        Stops a download started by `prefetch`, unless something is waiting for the entry to be ready by now.
+        """
+        if (
+            self._download_task
+            and not self._download_task.done()
+            and not self._waiting_futures
+        ):
+            log.debug("Cancelling prefetch of {}".format(self.title))
+            self._download_task.cancel()
+
+            for future in self._prefetch_ticket.downloads:
+                if not future.cancel():
+                    self._abandon_download(future)
+
+    def _abandon_download(self, future):
+        """
+        Keeps track of a download that already got a thread when it was cancelled.  yt-dlp can't be stopped, so
+        the file it writes is dealt with once it's done, unless the entry is being downloaded again by then.
+        """
+        self._abandoned_download = future
+        loop = self.playlist.loop
+        future.add_done_callback(
+            lambda future: loop.call_soon_threadsafe(
+                self._abandoned_download_done, future
+            )
+        )
+
+    def _abandoned_download_done(self, future):
+        if self._abandoned_download is future:
+            self._abandoned_download = None
+
+        if self._is_downloading or future.cancelled() or future.exception():
+            return
+
+        self._discard_download(future.result())
+
+    def _discard_download(self, info):
+        """
+        Deals with the file of a download nothing is waiting for anymore, `info` is what the download returned.
+        """
+        pass
+
+    def stop_streaming(self):
+        """
+        Called when the entry finished playing from `playback_url` before its download did.  Returns the download
+        task, so the file can be dealt with once it's there.
+        """
+        self.playback_url = None
+        return self._download_task
+
+    def get_ready_future(self, *, prefetch=False):
         """
         Returns a future that will fire when the song is ready to be played. The future will either fire with the result (being the entry) or an exception
-        as to why the song download failed.
+        as to why the song download failed.  `prefetch` marks a download that nobody is waiting on yet.
         """
         future = asyncio.Future()
-        if self.is_downloaded:
-            # In the event that we're downloaded, we're already ready for playback.
+        if self.is_downloaded or self.playback_url:
+            # In the event that we're downloaded (or can be played while we are), we're already ready for playback.
             future.set_result(self)
 
         else:
             # If we request a ready future, let's ensure that it'll actually resolve at one point.
             self._waiting_futures.append(future)
-            asyncio.ensure_future(self._download())
+            self._start_download(prefetch)
 
         log.debug("Created future for {0}".format(self.filename))
         return future
@@ -104,10 +208,82 @@ class URLPlaylistEntry(BasePlaylistEntry):
                 "entry name: {}".format(self.title)
             )
         self.expected_filename = expected_filename
+        self.filesize = None
         self.meta = meta
         self.aoptions = "-vn"
+        # the audio codec of the downloaded file, probed when it's first played with opus passthrough on
+        self.codec = None
+        self._measure_task = None
+
+        # where the media can be streamed from while it downloads, see `remember_stream`
+        self.stream_url = None
+        self.stream_headers = {}
+        self.stream_time = 0
 
         self.download_folder = self.playlist.downloader.download_folder
+        self._pinned = None
+
+    def pin(self):
+        if self.filename and self._pinned != self.filename:
+            self.unpin()
+            self.playlist.downloader.audio_cache.pin(self.filename)
+            self._pinned = self.filename
+
+    def unpin(self):
+        if self._pinned:
+            self.playlist.downloader.audio_cache.unpin(self._pinned)
+            self._pinned = None
+
+    def remember_stream(self, info):
+        """
+        Keeps the media url from the processed `info` around, so playback can start from it before the
+        download finishes.
+        """
+        if info.get("url") and info.get("protocol") in (
+            "http",
+            "https",
+            "m3u8",
+            "m3u8_native",
+        ):
+            self.stream_url = info["url"]
+            self.stream_headers = info.get("http_headers") or {}
+            # the info can come from the extraction cache, the url is as old as the extraction
+            self.stream_time = info.get("_extracted", 0)
+
+    def _start_progressive(self):
+        if not self.playlist.bot.config.progressive_playback or not self.stream_url:
+            return
+
+        if time.time() - self.stream_time > STREAM_URL_TTL:
+            log.debug("Media url of {} is too old to stream from".format(self.title))
+            return
+
+        log.debug("Playing {} while it downloads".format(self.title))
+        self.playback_url = self.stream_url
+        self._for_each_future(lambda future: future.set_result(self))
+
+    def stream_options(self):
+        """
+        The ffmpeg input options needed to play from `playback_url`.
+        """
+        options = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+        if self.stream_headers:
+            options += " -headers " + shlex.quote(
+                "".join(
+                    "{}: {}\r\n".format(name, value)
+                    for name, value in self.stream_headers.items()
+                )
+            )
+
+        return options
+
+    @property
+    def estimated_size(self):
+        if self.filesize:
+            return self.filesize
+
+        # assume a 160kbps stream, which is about what youtube serves
+        return (self.duration or 0) * 20000
 
     def __json__(self):
         return self._enclose_json(
@@ -118,6 +294,7 @@ class URLPlaylistEntry(BasePlaylistEntry):
                 "duration": self.duration,
                 "downloaded": self.is_downloaded,
                 "expected_filename": self.expected_filename,
+                "filesize": self.filesize,
                 "filename": self.filename,
                 "full_filename": os.path.abspath(self.filename)
                 if self.filename
@@ -145,7 +322,10 @@ class URLPlaylistEntry(BasePlaylistEntry):
             title = data["title"]
             duration = data["duration"]
             downloaded = (
-                data["downloaded"] if playlist.bot.config.save_videos else False
+                data["downloaded"]
+                if playlist.bot.config.save_videos
+                or playlist.bot.config.audio_cache_size
+                else False
             )
             filename = data["filename"] if downloaded else None
             expected_filename = data["expected_filename"]
@@ -178,14 +358,16 @@ class URLPlaylistEntry(BasePlaylistEntry):
                         meta.pop("author")
 
             entry = cls(playlist, url, title, duration, expected_filename, **meta)
+            entry.filesize = data.get("filesize")
             entry.filename = filename
+            entry.pin()
 
             return entry
         except Exception as e:
             log.error("Could not load {}".format(cls.__name__), exc_info=e)
 
     # noinspection PyTypeChecker
-    async def _download(self):
+    async def _download(self, *, prefetch=False):
         if self._is_downloading:
             return
 
@@ -195,19 +377,20 @@ class URLPlaylistEntry(BasePlaylistEntry):
             if not os.path.exists(self.download_folder):
                 os.makedirs(self.download_folder)
 
+            audio_cache = self.playlist.downloader.audio_cache
+            await audio_cache.sync(self.playlist.loop)
+
             # self.expected_filename: audio_cache\youtube-9R8aSKwTEMg-NOMA_-_Brain_Power.m4a
-            extractor = os.path.basename(self.expected_filename).split("-")[0]
+            expected_fname_base = os.path.basename(self.expected_filename)
+            extractor = expected_fname_base.split("-")[0]
 
             # the generic extractor requires special handling
             if extractor == "generic":
-                flistdir = [
-                    f.rsplit("-", 1)[0] for f in os.listdir(self.download_folder)
-                ]
-                expected_fname_noex, fname_ex = os.path.basename(
-                    self.expected_filename
-                ).rsplit(".", 1)
-
-                if expected_fname_noex in flistdir:
+                cached = await audio_cache.find(
+                    self.playlist.loop, expected_fname_base, generic=True
+                )
+
+                if cached:
                     try:
                         rsize = int(
                             await get_header(
@@ -217,49 +400,35 @@ class URLPlaylistEntry(BasePlaylistEntry):
                     except:
                         rsize = 0
 
-                    lfile = os.path.join(
-                        self.download_folder,
-                        os.listdir(self.download_folder)[
-                            flistdir.index(expected_fname_noex)
-                        ],
-                    )
+                    # print("Remote size: %s Local size: %s" % (rsize, cached.size))
 
-                    # print("Resolved %s to %s" % (self.expected_filename, lfile))
-                    lsize = os.path.getsize(lfile)
-                    # print("Remote size: %s Local size: %s" % (rsize, lsize))
-
-                    if lsize != rsize:
-                        await self._really_download(hash=True)
+                    if cached.size != rsize:
+                        await self._really_download(hash=True, prefetch=prefetch)
                     else:
                         # print("[Download] Cached:", self.url)
-                        self.filename = lfile
+                        self.filename = os.path.join(self.download_folder, cached.name)
 
                 else:
                     # print("File not found in cache (%s)" % expected_fname_noex)
-                    await self._really_download(hash=True)
+                    await self._really_download(hash=True, prefetch=prefetch)
 
             else:
-                ldir = os.listdir(self.download_folder)
-                flistdir = [f.rsplit(".", 1)[0] for f in ldir]
-                expected_fname_base = os.path.basename(self.expected_filename)
-                expected_fname_noex = expected_fname_base.rsplit(".", 1)[0]
+                cached = await audio_cache.find(
+                    self.playlist.loop, expected_fname_base
+                )
 
                 # idk wtf this is but its probably legacy code
                 # or i have youtube to blame for changing shit again
 
-                if expected_fname_base in ldir:
-                    self.filename = os.path.join(
-                        self.download_folder, expected_fname_base
-                    )
+                if cached and cached.name == expected_fname_base:
+                    self.filename = os.path.join(self.download_folder, cached.name)
                     log.info("Download cached: {}".format(self.url))
 
-                elif expected_fname_noex in flistdir:
+                elif cached:
                     log.info(
                         "Download cached (different extension): {}".format(self.url)
                     )
-                    self.filename = os.path.join(
-                        self.download_folder, ldir[flistdir.index(expected_fname_noex)]
-                    )
+                    self.filename = os.path.join(self.download_folder, cached.name)
                     log.debug(
                         "Expected {}, got {}".format(
                             self.expected_filename.rsplit(".", 1)[-1],
@@ -267,7 +436,19 @@ class URLPlaylistEntry(BasePlaylistEntry):
                         )
                     )
                 else:
-                    await self._really_download()
+                    await self._really_download(prefetch=prefetch)
+
+            duration = self.duration
+            if cached and self.filename.endswith(cached.name):
+                if self.duration == None:
+                    self.duration = cached.duration
+
+            self.filesize = os.path.getsize(self.filename)
+
+            # don't pin entries that were removed from the queue while they downloaded
+            if self._waiting_futures or self.playback_url or self in self.playlist.entries:
+                self.pin()
+            await audio_cache.trim(self.playlist.loop)
 
             if self.duration == None:
                 if pymediainfo:
@@ -313,18 +494,46 @@ class URLPlaylistEntry(BasePlaylistEntry):
                             self.filename, self.duration
                         )
                     )
+                    await audio_cache.update(
+                        self.playlist.loop, self.filename, duration=self.duration
+                    )
+
+            if self.duration != duration:
+                self.playlist.duration_changed(self)
 
-            if self.playlist.bot.config.use_experimental_equalization:
+            config = self.playlist.bot.config
+            aoptions = "-vn"
+
+            if config.use_experimental_equalization:
                 try:
-                    aoptions = await self.get_mean_volume(self.filename)
+                    loudness = await audio_cache.get_loudness(
+                        self.playlist.loop, self.filename
+                    )
+                    if loudness is not None:
+                        log.debug("Using stored loudness of {}".format(self.filename))
+
+                    elif config.deferred_equalization:
+                        # play at unity gain for now and adjust once the analysis is done
+                        self._measure_task = asyncio.ensure_future(
+                            self._measure_gain()
+                        )
+
+                    else:
+                        loudness = await self.measure_loudness(self.filename)
+                        if all(value is not None for value in loudness.values()):
+                            await audio_cache.set_loudness(
+                                self.playlist.loop, self.filename, loudness
+                            )
+
+                    if loudness is not None and config.deferred_equalization:
+                        self.gain = self.loudness_gain(loudness)
+                    elif loudness is not None:
+                        aoptions = self.loudnorm_options(loudness)
                 except Exception as e:
                     log.error(
                         "There as a problem with working out EQ, likely caused by a strange installation of FFmpeg. "
                         "This has not impacted the ability for the bot to work, but will mean your tracks will not be equalised."
                     )
-                    aoptions = "-vn"
-            else:
-                aoptions = "-vn"
 
             self.aoptions = aoptions
 
@@ -337,6 +546,7 @@ class URLPlaylistEntry(BasePlaylistEntry):
 
         finally:
             self._is_downloading = False
+            self.playback_url = None
 
     async def run_command(self, cmd):
         p = await asyncio.create_subprocess_shell(
@@ -368,6 +578,13 @@ class URLPlaylistEntry(BasePlaylistEntry):
         return None
 
     async def get_mean_volume(self, input_file):
+        return self.loudnorm_options(await self.measure_loudness(input_file))
+
+    async def measure_loudness(self, input_file):
+        """
+        Runs the analysis pass of ffmpeg's loudnorm filter over `input_file`.  Returns a dict of the measured
+        values, a value that couldn't be parsed from ffmpeg's output is None.
+        """
         log.debug("Calculating mean volume of {0}".format(input_file))
         cmd = (
             '"'
@@ -381,64 +598,75 @@ class URLPlaylistEntry(BasePlaylistEntry):
         log.debug(output)
         # print('----', output)
 
-        I_matches = re.findall(r'"input_i" : "([-]?([0-9]*\.[0-9]+))",', output)
-        if I_matches:
-            log.debug("I_matches={}".format(I_matches[0][0]))
-            I = float(I_matches[0][0])
-        else:
-            log.debug("Could not parse I in normalise json.")
-            I = float(0)
+        loudness = {}
+        for field in LOUDNESS_FIELDS:
+            matches = re.findall(
+                r'"{}" : "([-]?([0-9]*\.[0-9]+))"'.format(field), output
+            )
+            if matches:
+                log.debug("{}={}".format(field, matches[0][0]))
+                loudness[field] = float(matches[0][0])
+            else:
+                log.debug("Could not parse {} in normalise json.".format(field))
+                loudness[field] = None
 
-        LRA_matches = re.findall(r'"input_lra" : "([-]?([0-9]*\.[0-9]+))",', output)
-        if LRA_matches:
-            log.debug("LRA_matches={}".format(LRA_matches[0][0]))
-            LRA = float(LRA_matches[0][0])
-        else:
-            log.debug("Could not parse LRA in normalise json.")
-            LRA = float(0)
+        return loudness
 
-        TP_matches = re.findall(r'"input_tp" : "([-]?([0-9]*\.[0-9]+))",', output)
-        if TP_matches:
-            log.debug("TP_matches={}".format(TP_matches[0][0]))
-            TP = float(TP_matches[0][0])
-        else:
-            log.debug("Could not parse TP in normalise json.")
-            TP = float(0)
+    async def _measure_gain(self):
+        """
+        Measures the loudness of the downloaded file in the background and sets the gain that brings it to the
+        same target loudnorm would.  Emits `entry-gain-changed` on the playlist so a player that's already
+        playing the entry can pick it up.
+        """
+        try:
+            loudness = await self.measure_loudness(self.filename)
+        except Exception:
+            log.error("Could not measure the loudness of {}".format(self.filename))
+            log.debug("", exc_info=True)
+            return
+
+        if not all(value is not None for value in loudness.values()):
+            return
 
-        thresh_matches = re.findall(
-            r'"input_thresh" : "([-]?([0-9]*\.[0-9]+))",', output
+        await self.playlist.downloader.audio_cache.set_loudness(
+            self.playlist.loop, self.filename, loudness
         )
-        if thresh_matches:
-            log.debug("thresh_matches={}".format(thresh_matches[0][0]))
-            thresh = float(thresh_matches[0][0])
-        else:
-            log.debug("Could not parse thresh in normalise json.")
-            thresh = float(0)
 
-        offset_matches = re.findall(
-            r'"target_offset" : "([-]?([0-9]*\.[0-9]+))', output
+        self.gain = self.loudness_gain(loudness)
+        log.debug("Measured gain of {:.2f} for {}".format(self.gain, self.title))
+        self.playlist.emit("entry-gain-changed", playlist=self.playlist, entry=self)
+
+    @staticmethod
+    def loudness_gain(loudness, target=-24.0, true_peak=-2.0):
+        """
+        Returns the linear gain that brings `loudness` to `target` LUFS without pushing peaks over `true_peak`.
+        """
+        gain_db = min(
+            target - loudness["input_i"], true_peak - loudness["input_tp"]
         )
-        if offset_matches:
-            log.debug("offset_matches={}".format(offset_matches[0][0]))
-            offset = float(offset_matches[0][0])
-        else:
-            log.debug("Could not parse offset in normalise json.")
-            offset = float(0)
+        return 10 ** (gain_db / 20)
 
+    @staticmethod
+    def loudnorm_options(loudness):
         return "-af loudnorm=I=-24.0:LRA=7.0:TP=-2.0:linear=true:measured_I={}:measured_LRA={}:measured_TP={}:measured_thresh={}:offset={}".format(
-            I, LRA, TP, thresh, offset
+            *(loudness[field] or float(0) for field in LOUDNESS_FIELDS)
         )
 
     # noinspection PyShadowingBuiltins
-    async def _really_download(self, *, hash=False):
+    async def _really_download(self, *, hash=False, prefetch=False):
         log.info("Download started: {}".format(self.url))
+        self._start_progressive()
 
         retry = True
         while retry:
             try:
-                result = await self.playlist.downloader.extract_info(
-                    self.playlist.loop, self.url, download=True
-                )
+                if self._abandoned_download:
+                    # a cancelled download is still writing the file, a second one would write to it as well
+                    result = await asyncio.wrap_future(self._abandoned_download)
+                else:
+                    result = await self.playlist.downloader.extract_info(
+                        self.playlist.loop, self.url, download=True, prefetch=prefetch
+                    )
                 break
             except Exception as e:
                 raise ExtractionError(e)
@@ -467,6 +695,31 @@ class URLPlaylistEntry(BasePlaylistEntry):
                 # Move the temporary file to it's final location.
                 os.rename(unhashed_fname, self.filename)
 
+        await self.playlist.downloader.audio_cache.add(
+            self.playlist.loop, self.filename, duration=self.duration
+        )
+
+    def _discard_download(self, info):
+        filename = self.playlist.downloader.ytdl.prepare_filename(info)
+        config = self.playlist.bot.config
+        audio_cache = self.playlist.downloader.audio_cache
+
+        if config.save_videos or config.audio_cache_size:
+            log.debug("Keeping {} from a cancelled download".format(filename))
+            asyncio.ensure_future(self._keep_download(filename))
+            return
+
+        log.debug("Deleting {} from a cancelled download".format(filename))
+        try:
+            os.unlink(filename)
+        except OSError:
+            log.debug("Could not delete {}".format(filename), exc_info=True)
+
+    async def _keep_download(self, filename):
+        audio_cache = self.playlist.downloader.audio_cache
+        await audio_cache.add(self.playlist.loop, filename, duration=self.duration)
+        await audio_cache.trim(self.playlist.loop)
+
 
 class StreamPlaylistEntry(BasePlaylistEntry):
     def __init__(self, playlist, url, title, *, destination=None, **meta):
@@ -533,18 +786,18 @@ class StreamPlaylistEntry(BasePlaylistEntry):
             log.error("Could not load {}".format(cls.__name__), exc_info=e)
 
     # noinspection PyMethodOverriding
-    async def _download(self, *, fallback=False):
+    async def _download(self, *, fallback=False, prefetch=False):
         self._is_downloading = True
 
         url = self.destination if fallback else self.url
 
         try:
             result = await self.playlist.downloader.extract_info(
-                self.playlist.loop, url, download=False
+                self.playlist.loop, url, download=False, prefetch=prefetch
             )
         except Exception as e:
             if not fallback and self.destination:
-                return await self._download(fallback=True)
+                return await self._download(fallback=True, prefetch=prefetch)
 
             raise ExtractionError(e)
         else:
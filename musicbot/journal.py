@@ -0,0 +1,326 @@
+import os
+import json
+import asyncio
+import logging
+import weakref
+
+from .constructs import Serializer
+
+log = logging.getLogger(__name__)
+
+
+class QueueJournal:
+    """
+    Keeps a guild's queue on disk as a snapshot of the whole player, the queue.json that was always written, and a
+    journal next to it of every change to the queue since, one json object per line.  Changing the queue only
+    appends a line, and every `compact_after` lines the snapshot is rewritten and the journal emptied.
+
+    Both files are replaced by writing a temporary file and renaming it over the old one, so a crash leaves either
+    the old or the new file but never half of one.  The snapshot and the journal carry a generation number, and a
+    journal is only replayed on top of the snapshot with the same one, so a crash between writing the snapshot and
+    emptying the journal doesn't replay changes the snapshot already has.  With `fsync`, every write is flushed to
+    the disk before carrying on, which survives a power cut but is a lot slower.
+
+    Changes are kept in memory until they're written.  Without a `scheduler` that's right away, with one it's up to
+    the scheduler, which calls `take` on the event loop and `write` with what it returned from wherever it likes.
+
+    The journal only follows the queue, and the player tells it when the current entry finished or it stopped.
+    Taking the next entry off the queue makes it the current one, before the player gets to it, and where in the
+    current song the player is only gets saved with the snapshot.
+    """
+
+    def __init__(self, path, *, fsync=False, compact_after=200, scheduler=None):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + ".journal"
+        self.fsync = fsync
+        self.compact_after = compact_after
+        self.scheduler = scheduler
+        self.generation = 0
+        self.ops = 0
+        self._player = None
+        self._pending = []
+        self._compact = False
+        self._current = None
+
+    def attach(self, player):
+        """
+        Starts journaling the queue of `player`, from a fresh snapshot of it.
+        """
+        self._player = player
+        self._current = player.current_entry
+        player.playlist.journal = self
+        self.compact()
+        self._changed()
+
+    def close(self):
+        """
+        Stops recording changes.  The ones that were recorded still get written.
+        """
+        self._player = None
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @property
+    def compaction_due(self):
+        return self._compact and self._player is not None
+
+    def record(self, op, **data):
+        """
+        Adds an operation on the queue to the journal, and has it compacted if it's grown long enough.
+        """
+        if not self._player:
+            return
+
+        # keep track of the current entry the same way replaying does
+        if op == "pop":
+            self._current = data.pop("entry")
+        elif op in ("finish", "stop"):
+            self._current = None
+
+        data["op"] = op
+        self._pending.append(json.dumps(data, cls=Serializer) + "\n")
+
+        self.ops += 1
+        if self.ops >= self.compact_after:
+            self.compact()
+        self._changed()
+
+    def compact(self):
+        """
+        Makes the next write a snapshot of the player, which empties the journal.
+        """
+        self._compact = True
+
+    def _changed(self):
+        if self.scheduler:
+            self.scheduler.changed(self)
+        else:
+            self.write(self.take())
+
+    def take(self):
+        """
+        Takes what has to be written since the last call, for `write`, or None if there's nothing.  This has to run
+        on the event loop, where the player can't change halfway through.
+        """
+        if self.compaction_due:
+            # the snapshot has every change so far in it, the pending ones don't need writing anymore
+            self._compact = False
+            self._pending = []
+            self.ops = 0
+            self.generation += 1
+            return self.generation, self._snapshot(), []
+
+        if self._pending:
+            lines, self._pending = self._pending, []
+            return None, None, lines
+
+    def write(self, taken):
+        """
+        Writes what `take` returned to the disk.  This doesn't touch the player, so it can run in another thread.
+        """
+        if not taken:
+            return
+
+        generation, snapshot, lines = taken
+        if snapshot is not None:
+            self._write(self.path, snapshot)
+            self._write(self.journal_path, json.dumps({"generation": generation}) + "\n")
+
+        if lines:
+            with open(self.journal_path, "a", encoding="utf8") as f:
+                f.write("".join(lines))
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def _snapshot(self):
+        snapshot = self._player.__json__()
+        snapshot["generation"] = self.generation
+        current = snapshot["data"]["current_entry"]["entry"]
+        if self._current is not None and current is not self._current:
+            # the player hasn't started the entry it took off the queue yet
+            snapshot["data"]["current_entry"] = {
+                "entry": self._current,
+                "progress": None,
+                "progress_frames": None,
+            }
+        return json.dumps(snapshot, cls=Serializer, sort_keys=True)
+
+    def load(self):
+        """
+        Reads the snapshot and replays the journal on top of it.  Returns the result as json to be deserialized like
+        a queue.json, or None if there's no snapshot.
+        """
+        if not os.path.isfile(self.path):
+            return None
+
+        with open(self.path, "r", encoding="utf8") as f:
+            snapshot = json.load(f)
+
+        self.generation = snapshot.pop("generation", 0)
+        ops = self._read_journal()
+        if ops:
+            log.debug(
+                "Replaying %s queue changes from %s", len(ops), self.journal_path
+            )
+            self._replay(snapshot["data"], ops)
+
+        return json.dumps(snapshot)
+
+    def _read_journal(self):
+        if not os.path.isfile(self.journal_path):
+            return []
+
+        with open(self.journal_path, "r", encoding="utf8") as f:
+            lines = f.read().splitlines()
+
+        try:
+            generation = json.loads(lines[0])["generation"]
+        except (IndexError, ValueError, KeyError, TypeError):
+            log.warning("Ignoring %s, it has no header", self.journal_path)
+            return []
+
+        if generation != self.generation:
+            # the snapshot was written after this journal, it's already in there
+            self.generation = max(self.generation, generation)
+            return []
+
+        ops = []
+        for line in lines[1:]:
+            try:
+                ops.append(json.loads(line))
+            except ValueError:
+                # the bot stopped halfway through writing this line, nothing after it made it to the disk
+                log.warning("Stopped replaying %s at a broken line", self.journal_path)
+                break
+
+        return ops
+
+    @staticmethod
+    def _replay(player, ops):
+        """
+        Applies `ops` to the serialized `player`.  Taking the next entry makes it the current one, so the current
+        entry and its progress change along with the queue.
+        """
+        nothing = {"entry": None, "progress": None, "progress_frames": None}
+        current = player["current_entry"]
+        queue = player["entries"]["data"]["entries"]
+
+        for op in ops:
+            try:
+                kind = op["op"]
+                if kind == "add":
+                    if op["head"]:
+                        queue.insert(0, op["entry"])
+                    else:
+                        queue.append(op["entry"])
+
+                elif kind == "remove":
+                    del queue[op["index"]]
+
+                elif kind == "pop":
+                    current = dict(nothing, entry=queue.pop(op.get("index", 0)))
+
+                elif kind == "order":
+                    queue[:] = [queue[i] for i in op["order"]]
+
+                elif kind == "clear":
+                    queue.clear()
+
+                elif kind in ("finish", "stop"):
+                    current = nothing
+
+                else:
+                    raise ValueError("unknown operation %r" % kind)
+
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                log.warning("Stopped replaying the queue journal at %s: %s", op, e)
+                break
+
+        player["current_entry"] = current
+
+    def _write(self, path, text):
+        temp = path + ".tmp"
+        with open(temp, "w", encoding="utf8") as f:
+            f.write(text)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        os.replace(temp, path)
+
+        if self.fsync and hasattr(os, "O_DIRECTORY"):
+            # the rename itself only survives a power cut once the folder is on the disk too
+            fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class JournalFlusher:
+    """
+    Writes queue journals to the disk in the background.  A journal with changes is written `delay` seconds after
+    the first one, so a burst of changes such as a playlist being queued ends up in a single write, or right away
+    once `max_changes` are waiting or it needs compacting.  The writing itself happens in a thread.
+    """
+
+    def __init__(self, loop, *, delay=5.0, max_changes=50):
+        self.loop = loop
+        self.delay = delay
+        self.max_changes = max_changes
+        self.writes = 0
+        self._timers = {}  # journal -> TimerHandle of its next flush
+        self._locks = weakref.WeakKeyDictionary()
+
+    def changed(self, journal):
+        urgent = journal.pending >= self.max_changes or journal.compaction_due
+        timer = self._timers.get(journal)
+
+        if timer and (not urgent or timer.when() <= self.loop.time()):
+            return
+
+        if timer:
+            timer.cancel()
+        self._timers[journal] = self.loop.call_later(
+            0 if urgent else self.delay, self._flush_later, journal
+        )
+
+    def _flush_later(self, journal):
+        asyncio.ensure_future(self._flush_logged(journal))
+
+    async def _flush_logged(self, journal):
+        try:
+            await self.flush(journal)
+        except Exception:
+            log.error("Could not save the queue to %s", journal.path, exc_info=True)
+
+    async def flush(self, journal, *, compact=False):
+        """
+        Writes `journal` now, as a fresh snapshot with `compact`, and waits for it to be on the disk.
+        """
+        timer = self._timers.pop(journal, None)
+        if timer:
+            timer.cancel()
+
+        if journal not in self._locks:
+            self._locks[journal] = asyncio.Lock()
+
+        # one write per journal at a time, so they land in the order they were taken
+        async with self._locks[journal]:
+            if compact:
+                journal.compact()
+
+            taken = journal.take()
+            if taken:
+                self.writes += 1
+                await self.loop.run_in_executor(None, journal.write, taken)
+
+    async def flush_all(self):
+        """
+        Writes every journal that has changes waiting or is being written, for shutting down.
+        """
+        journals = set(self._timers) | set(self._locks.keys())
+        await asyncio.gather(*(self.flush(journal) for journal in journals))
@@ -0,0 +1,301 @@
+import random
+
+from collections import defaultdict
+
+
+class IndexedDeque:
+    """
+    A deque that can also be indexed and have items removed from anywhere without walking the whole thing.
+
+    Items are kept in blocks of at most `block_size`, with a fenwick tree over the block sizes to find which
+    block an index falls in, so indexing, deleting and appending to either end are O(log n).  The tree is only
+    rebuilt when a block is added or dropped, once every `block_size` items at most.  Every item remembers its
+    block, so `in` and `remove` don't search for it either.
+
+    With a `key` function, items are also grouped by their key, which makes counting or finding the items with
+    a certain key independent of the length of the deque.  With a `weight` function, the weights of the items
+    are summed per block in two more trees and per key, so the total weight of the first n items or of a key
+    is as cheap to get as an item.  A weight of None means unknown, and those are counted instead of summed.
+    Weights are taken when an item is added, `reweigh` has to be called if an item's weight changes after.
+
+    Items are told apart by identity, so one object can't be in the deque twice.
+    """
+
+    def __init__(self, iterable=(), *, key=None, weight=None, block_size=64):
+        self.key = key
+        self.weight = weight
+        self.block_size = block_size
+        self.clear()
+        self.extend(iterable)
+
+    def clear(self):
+        self._blocks = []
+        # fenwick trees, 1-based, over len(block), the known weights in a block and the unknown ones
+        self._tree = [0]
+        self._sums = [0]
+        self._unknown = [0]
+        self._block_pos = {}  # id(block) -> index in _blocks
+        self._block_of = {}  # id(item) -> block
+        self._weight_of = {}  # id(item) -> weight
+        self._by_key = defaultdict(dict)  # key -> {id(item): item}
+        self._key_weight = defaultdict(lambda: [0, 0])  # key -> [known weight, unknown count]
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for block in self._blocks:
+            yield from block
+
+    def __reversed__(self):
+        for block in reversed(self._blocks):
+            yield from reversed(block)
+
+    def __contains__(self, item):
+        return id(item) in self._block_of
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._len))]
+
+        pos, offset = self._locate(index)
+        return self._blocks[pos][offset]
+
+    def __delitem__(self, index):
+        pos, offset = self._locate(index)
+        self._take(pos, offset)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, list(self))
+
+    def append(self, item):
+        self._check_new(item)
+        if not self._blocks or len(self._blocks[-1]) >= self.block_size:
+            self._blocks.append([])
+            self._rebuild()
+
+        self._blocks[-1].append(item)
+        self._added(item, len(self._blocks) - 1)
+
+    def appendleft(self, item):
+        self._check_new(item)
+        if not self._blocks or len(self._blocks[0]) >= self.block_size:
+            self._blocks.insert(0, [])
+            self._rebuild()
+
+        self._blocks[0].insert(0, item)
+        self._added(item, 0)
+
+    def extend(self, iterable):
+        for item in iterable:
+            self.append(item)
+
+    def pop(self):
+        if not self._len:
+            raise IndexError("pop from an empty deque")
+        return self._take(len(self._blocks) - 1, len(self._blocks[-1]) - 1)
+
+    def popleft(self):
+        if not self._len:
+            raise IndexError("pop from an empty deque")
+        return self._take(0, 0)
+
+    def remove(self, item):
+        block = self._block_of.get(id(item))
+        if block is None:
+            raise ValueError("{!r} is not in deque".format(item))
+
+        self._take(self._block_pos[id(block)], self._offset(block, item))
+
+    def index(self, item):
+        block = self._block_of.get(id(item))
+        if block is None:
+            raise ValueError("{!r} is not in deque".format(item))
+
+        return self._prefix(self._block_pos[id(block)]) + self._offset(block, item)
+
+    def count_key(self, key):
+        return len(self._by_key.get(key, ()))
+
+    def with_key(self, key):
+        """
+        Returns the items with `key`, in no particular order.
+        """
+        return list(self._by_key.get(key, {}).values())
+
+    def key_weight(self, key):
+        """
+        Returns the total known weight of the items with `key`, and how many of them have an unknown weight.
+        """
+        total, unknown = self._key_weight.get(key, (0, 0))
+        return total, unknown
+
+    def weight_before(self, index):
+        """
+        Returns the total known weight of the first `index` items, and how many of them have an unknown weight.
+        """
+        index = max(0, min(index, self._len))
+        if index == self._len:
+            return self._prefix(len(self._blocks), self._sums), self._prefix(
+                len(self._blocks), self._unknown
+            )
+
+        pos, offset = self._locate(index)
+        total = self._prefix(pos, self._sums)
+        unknown = self._prefix(pos, self._unknown)
+
+        for item in self._blocks[pos][:offset]:
+            weight = self._weight_of[id(item)]
+            if weight is None:
+                unknown += 1
+            else:
+                total += weight
+
+        return total, unknown
+
+    @property
+    def total_weight(self):
+        return self.weight_before(self._len)
+
+    def reweigh(self, item):
+        block = self._block_of.get(id(item))
+        if block is None or not self.weight:
+            return
+
+        pos = self._block_pos[id(block)]
+        self._weigh(item, pos, -1)
+        self._weight_of[id(item)] = self.weight(item)
+        self._weigh(item, pos, 1)
+
+    def shuffle(self):
+        items = list(self)
+        random.shuffle(items)
+        self.clear()
+        self.extend(items)
+
+    def _check_new(self, item):
+        if id(item) in self._block_of:
+            raise ValueError("{!r} is already in deque".format(item))
+
+    def _added(self, item, pos):
+        self._block_of[id(item)] = self._blocks[pos]
+        if self.key:
+            self._by_key[self.key(item)][id(item)] = item
+
+        self._len += 1
+        self._update(pos, 1)
+
+        if self.weight:
+            self._weight_of[id(item)] = self.weight(item)
+            self._weigh(item, pos, 1)
+
+    def _take(self, pos, offset):
+        block = self._blocks[pos]
+        item = block.pop(offset)
+
+        if self.weight:
+            self._weigh(item, pos, -1)
+            del self._weight_of[id(item)]
+
+        del self._block_of[id(item)]
+        if self.key:
+            key = self.key(item)
+            items = self._by_key[key]
+            items.pop(id(item), None)
+            if not items:
+                del self._by_key[key]
+                self._key_weight.pop(key, None)
+
+        self._len -= 1
+        if block:
+            self._update(pos, -1)
+        else:
+            del self._blocks[pos]
+            self._rebuild()
+
+        return item
+
+    def _weigh(self, item, pos, sign):
+        """
+        Adds (sign 1) or subtracts (sign -1) the weight of `item`, which is in block `pos`, to the aggregates.
+        """
+        weight = self._weight_of[id(item)]
+        key_weight = self._key_weight[self.key(item)] if self.key else [0, 0]
+
+        if weight is None:
+            self._update(pos, sign, self._unknown)
+            key_weight[1] += sign
+        else:
+            self._update(pos, sign * weight, self._sums)
+            key_weight[0] += sign * weight
+
+    @staticmethod
+    def _offset(block, item):
+        for i, other in enumerate(block):
+            if other is item:
+                return i
+
+    def _rebuild(self):
+        # only when blocks are added or dropped, which is once every block_size items at most
+        self._block_pos = {id(block): i for i, block in enumerate(self._blocks)}
+        self._tree = self._build(len)
+
+        if self.weight:
+            weights = self._weight_of
+            self._sums = self._build(
+                lambda block: sum(
+                    weights[id(item)] for item in block if weights[id(item)] is not None
+                )
+            )
+            self._unknown = self._build(
+                lambda block: sum(1 for item in block if weights[id(item)] is None)
+            )
+
+    def _build(self, value):
+        tree = [0] * (len(self._blocks) + 1)
+
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += value(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+
+        return tree
+
+    def _update(self, pos, delta, tree=None):
+        tree = self._tree if tree is None else tree
+        i = pos + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, pos, tree=None):
+        """
+        Sum of the values in `tree` of the blocks before `pos`, the number of items in them by default.
+        """
+        tree = self._tree if tree is None else tree
+        total = 0
+        i = pos
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("deque index out of range")
+
+        # walk down the tree to the last block whose prefix is still <= index
+        pos = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= index:
+                pos = nxt
+                index -= self._tree[nxt]
+            step >>= 1
+
+        return pos, index
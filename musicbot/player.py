@@ -1,21 +1,25 @@
 import os
 import sys
-import json
 import logging
 import asyncio
-import audioop
 import subprocess
+import functools
 import re
 
-from discord import FFmpegPCMAudio, PCMVolumeTransformer, AudioSource
+from discord import (
+    FFmpegPCMAudio,
+    FFmpegOpusAudio,
+    AudioSource,
+    opus,
+)
 
 from enum import Enum
-from array import array
-from threading import Thread
+from threading import Thread, Lock
 from collections import deque
 from shutil import get_terminal_size
 
 from .utils import avg, _func_
+from .volume import VolumeTransformer, audioop, numpy, scale, mix
 from .lib.event_emitter import EventEmitter
 from .constructs import Serializable, Serializer
 from .exceptions import FFmpegError, FFmpegWarning
@@ -51,7 +55,7 @@ class PatchedBuff:
         if self.volume != 1:
             frame = self._frame_vol(frame, self.volume, maxv=2)
 
-        if self.draw and not self.frame_count % self.frame_skip:
+        if self.draw and audioop and not self.frame_count % self.frame_skip:
             # these should be processed for every frame, but "overhead"
             rms = audioop.rms(frame, 2)
             self.rmss.append(rms)
@@ -65,16 +69,9 @@ class PatchedBuff:
         return frame
 
     def _frame_vol(self, frame, mult, *, maxv=2, use_audioop=True):
-        if use_audioop:
-            return audioop.mul(frame, 2, min(mult, maxv))
-        else:
-            # ffmpeg returns s16le pcm frames.
-            frame_array = array("h", frame)
-
-            for i in range(len(frame_array)):
-                frame_array[i] = int(frame_array[i] * min(mult, min(1, maxv)))
-
-            return frame_array.tobytes()
+        # ffmpeg returns s16le pcm frames.
+        engine = None if use_audioop else "numpy" if numpy else "array"
+        return scale(frame, min(mult, maxv), engine=engine)
 
     def _pprint_meter(self, perc, *, char="#", text="", shift=True):
         tx, ty = get_terminal_size()
@@ -101,24 +98,317 @@ class MusicPlayerState(Enum):
 
 
 class SourcePlaybackCounter(AudioSource):
-    def __init__(self, source, progress=0):
+    """
+    Keeps track of how far into the song playback is from the pcm that was read, 192k bytes a second (48kHz,
+    16 bit, stereo), rather than assuming every read is a whole 20ms frame.  Opus packets are 20ms whatever
+    their size, so those are counted instead.  `start` is the position in seconds the source started at.
+    """
+
+    bytes_per_second = 48000 * 2 * 2
+
+    def __init__(self, source, start=0.0, stderr_future=None):
         self._source = source
-        self.progress = progress
+        self.start = start
+        self.stderr_future = stderr_future
+        self.bytes_read = 0
+        self.packets = 0
 
     def read(self):
         res = self._source.read()
         if res:
-            self.progress += 1
+            if self._source.is_opus():
+                self.packets += 1
+            else:
+                self.bytes_read += len(res)
         return res
 
     def get_progress(self):
-        return self.progress * 0.02
+        return self.start + self.bytes_read / self.bytes_per_second + self.packets * 0.02
+
+    @property
+    def frames(self):
+        return round(self.get_progress() / 0.02)
+
+    def is_opus(self):
+        return self._source.is_opus()
 
     def cleanup(self):
         self._source.cleanup()
 
 
+class TransitionSource(AudioSource):
+    """
+    What the voice client plays: the current entry's source, and the next entry's once it's lined up.  When
+    the current source runs out the next one is read from in the same frame, so there's no gap between them,
+    and with `fade_at` set the two are mixed from that position in the current entry on, for `fade_frames`.
+    The player is told about the switch through `on_handoff`, from the audio thread.
+    """
+
+    def __init__(self, source, on_handoff):
+        self.current = source
+        self.finished = False
+
+        self._on_handoff = on_handoff
+        self._lock = Lock()
+        self._next = None  # (source, entry)
+        self._fade_at = None
+        self._fade_frames = 0
+        self._faded = 0
+
+    def is_opus(self):
+        return self.current.is_opus()
+
+    def queue(self, source, entry, fade_at=None, fade_frames=0):
+        """
+        Lines `source` up to play after the current one.  Returns False if the current one already ended.
+        """
+        with self._lock:
+            if self.finished:
+                return False
+
+            self._next = (source, entry)
+            self._fade_at = fade_at if fade_frames else None
+            self._fade_frames = fade_frames
+            self._faded = 0
+            return True
+
+    def unqueue(self):
+        """
+        Takes back what was lined up, returning (source, entry) or None if nothing is.
+        """
+        with self._lock:
+            queued, self._next = self._next, None
+            return queued
+
+    def replace(self, source):
+        with self._lock:
+            self.current = source
+
+    def read(self):
+        with self._lock:
+            frame = self.current.read()
+
+            if not self._next:
+                if not frame:
+                    self.finished = True
+                return frame
+
+            if not frame:
+                return self._handoff()
+
+            if self._fade_at is not None and self.current.get_progress() >= self._fade_at:
+                incoming = self._next[0].read()
+                if incoming:
+                    self._faded += 1
+                    frame = mix(frame, incoming, min(1, self._faded / self._fade_frames))
+
+            return frame
+
+    def _handoff(self):
+        old = self.current
+        self.current, entry = self._next
+        self._next = None
+        self._fade_at = None
+
+        self._on_handoff(self, old, self.current, entry)
+        return self.current.read()
+
+    def cleanup(self):
+        with self._lock:
+            self.current.cleanup()
+            if self._next:
+                self._next[0].cleanup()
+                self._next = None
+
+
+class SharedDecoder:
+    """
+    Decodes a file once for every guild playing it at about the same position.  Frames are decoded when the
+    subscriber furthest ahead needs them and kept until every subscriber has read them, up to `max_buffer`
+    frames.  The last `retain` frames are kept regardless so a guild that starts the same song a little later
+    can still join in.
+    """
+
+    retain = 500  # 10 seconds
+    max_buffer = 1500  # 30 seconds
+
+    def __init__(self, hub, key, filename, aoptions, start=0):
+        self.hub = hub
+        self.key = key
+        self.filename = filename
+        self.aoptions = aoptions
+
+        self.base = round(start / 0.02)  # index of the first buffered frame
+        self.finished = False
+        self.subscribers = set()
+
+        self._frames = deque()
+        self._lock = Lock()
+
+        boptions = "-nostdin"
+        if start:
+            boptions += " -ss {:.2f}".format(start)
+
+        stderr, self.stderr_future = hub.stderr_reader.open()
+        with stderr:
+            self._source = FFmpegPCMAudio(
+                filename, before_options=boptions, options=aoptions, stderr=stderr
+            )
+
+    @property
+    def end(self):
+        return self.base + len(self._frames)
+
+    def join(self, frame):
+        """
+        Returns a new SharedDecoderSource reading from `frame` on, or None if that frame isn't buffered anymore.
+        """
+        with self._lock:
+            if self.finished or not self.base <= frame <= self.end:
+                return None
+
+            source = SharedDecoderSource(self, frame)
+            self.subscribers.add(source)
+            return source
+
+    def leave(self, source):
+        with self._lock:
+            self.subscribers.discard(source)
+            if self.subscribers:
+                return
+
+            # nobody can join anymore once we're on our way out
+            self.finished = True
+
+        self.hub.remove(self)
+        self._source.cleanup()
+
+    def frame_at(self, frame):
+        """
+        Returns the frame at index `frame`, b"" at the end of the file, or None if it isn't buffered anymore.
+        """
+        with self._lock:
+            if frame < self.base:
+                return None
+
+            while frame >= self.end:
+                if self.finished:
+                    return b""
+
+                data = self._source.read()
+                if not data:
+                    self.finished = True
+                    return b""
+
+                self._frames.append(data)
+
+            data = self._frames[frame - self.base]
+            self._trim()
+            return data
+
+    def _trim(self):
+        slowest = min((s.cursor for s in self.subscribers), default=self.end)
+        base = max(self.end - self.max_buffer, min(slowest, self.end - self.retain))
+
+        while self.base < base:
+            self._frames.popleft()
+            self.base += 1
+
+
+class SharedDecoderSource(AudioSource):
+    """
+    One guild's position in a SharedDecoder.  A guild that falls too far behind, because it was paused for
+    example, stops sharing and decodes the rest of the file by itself.
+    """
+
+    def __init__(self, decoder, cursor=0):
+        self.decoder = decoder
+        self.cursor = cursor
+        self._private = None
+
+    @property
+    def stderr_future(self):
+        return self.decoder.stderr_future
+
+    def read(self):
+        if self._private:
+            return self._private.read()
+
+        data = self.decoder.frame_at(self.cursor)
+        if data is None:
+            log.debug(
+                "Fell behind the shared decoder of {}, decoding it separately".format(
+                    self.decoder.filename
+                )
+            )
+            self._private = FFmpegPCMAudio(
+                self.decoder.filename,
+                before_options="-nostdin -ss {:.2f}".format(self.cursor * 0.02),
+                options=self.decoder.aoptions,
+                stderr=subprocess.DEVNULL,
+            )
+            self.decoder.leave(self)
+            return self._private.read()
+
+        self.cursor += 1
+        return data
+
+    def cleanup(self):
+        if self._private:
+            self._private.cleanup()
+            self._private = None
+        else:
+            self.decoder.leave(self)
+
+
+class DecoderHub:
+    """
+    Hands out SharedDecoderSources, joining a running SharedDecoder of the same file when one still has the
+    requested position buffered and starting a new one otherwise.
+    """
+
+    def __init__(self, stderr_reader):
+        self.stderr_reader = stderr_reader
+        self._decoders = {}
+        self._lock = Lock()
+
+    def subscribe(self, filename, aoptions, start=0):
+        key = (os.path.abspath(filename), aoptions)
+        frame = round(start / 0.02)
+
+        with self._lock:
+            for decoder in self._decoders.get(key, []):
+                source = decoder.join(frame)
+                if source:
+                    log.debug("Sharing the decoder of {}".format(filename))
+                    return source
+
+            decoder = SharedDecoder(self, key, filename, aoptions, start)
+            self._decoders.setdefault(key, []).append(decoder)
+            return decoder.join(frame)
+
+    def remove(self, decoder):
+        with self._lock:
+            decoders = self._decoders.get(decoder.key, [])
+            if decoder in decoders:
+                decoders.remove(decoder)
+            if not decoders:
+                self._decoders.pop(decoder.key, None)
+
+    @property
+    def stats(self):
+        with self._lock:
+            decoders = [d for ds in self._decoders.values() for d in ds]
+            return {
+                "decoders": len(decoders),
+                "subscribers": sum(len(d.subscribers) for d in decoders),
+            }
+
+
 class MusicPlayer(EventEmitter, Serializable):
+    # how long before the end of a song the next one is opened for a gapless transition, on top of any crossfade
+    transition_lead = 2.0
+
     def __init__(self, bot, voice_client, playlist):
         super().__init__()
         self.bot = bot
@@ -134,11 +424,16 @@ class MusicPlayer(EventEmitter, Serializable):
         self._play_lock = asyncio.Lock()
         self._current_player = None
         self._current_entry = None
-        self._stderr_future = None
+        self._resume_at = None  # (entry, seconds) to pick a restored entry up where it was
 
-        self._source = None
+        self._source = None  # the current entry's source
+        self._output = None  # what the voice client plays, the current source and whatever is lined up next
+        self._transition_task = None
+        self._handoffs = 0
 
         self.playlist.on("entry-added", self.on_entry_added)
+        self.playlist.on("entry-gain-changed", self.on_entry_gain_changed)
+        self.playlist.on("lined-up-changed", self.on_lined_up_changed)
 
     @property
     def volume(self):
@@ -147,8 +442,16 @@ class MusicPlayer(EventEmitter, Serializable):
     @volume.setter
     def volume(self, value):
         self._volume = value
-        if self._source:
-            self._source._source.volume = value
+        if not self._source or not self._current_entry:
+            return
+
+        volume = value * self._current_entry.gain
+        if self._source.is_opus() != self._passthrough_ok(self._current_entry, volume):
+            log.debug("Volume changed to {:.2f}, switching sources".format(volume))
+            self._swap_source(passthrough=not self._source.is_opus())
+
+        elif not self._source.is_opus():
+            self._source._source.volume = volume
 
     def on_entry_added(self, playlist, entry):
         if self.is_stopped:
@@ -156,12 +459,27 @@ class MusicPlayer(EventEmitter, Serializable):
 
         self.emit("entry-added", player=self, playlist=playlist, entry=entry)
 
+    def on_entry_gain_changed(self, playlist, entry):
+        if self._source and entry is self._current_entry:
+            log.debug("Applying gain of {:.2f} to {}".format(entry.gain, entry.title))
+            self.volume = self.volume
+
+    def on_lined_up_changed(self, playlist):
+        # the queue changed under the entry that was lined up, line up whatever is next now instead
+        self._cancel_transition()
+        if self._source and (self.is_playing or self.is_paused):
+            self._schedule_transition()
+
     def skip(self):
         self._kill_current_player()
 
     def stop(self):
         self.state = MusicPlayerState.STOPPED
+        # the bot doesn't continue a stopped player, so a handoff it hasn't continued from yet never will be
+        self._handoffs = 0
         self._kill_current_player()
+        if self.playlist.journal:
+            self.playlist.journal.record("stop")
 
         self.emit("stop", player=self)
 
@@ -196,12 +514,26 @@ class MusicPlayer(EventEmitter, Serializable):
 
     def kill(self):
         self.state = MusicPlayerState.DEAD
+        self._cancel_transition()
+        if self.playlist.journal:
+            # the saved queue is kept for the next time the bot joins
+            self.playlist.journal.close()
+            self.playlist.journal = None
         self.playlist.clear()
         self._events.clear()
         self._kill_current_player()
 
-    def _playback_finished(self, error=None):
+    def _playback_finished(self, output, error=None):
+        # called from the audio thread, the player and the playlist are only touched on the event loop
+        self.loop.call_soon_threadsafe(self._handle_playback_finished, output, error)
+
+    def _handle_playback_finished(self, output, error):
+        if output is not self._output:
+            # a leftover from playback that was already replaced
+            return
+
         entry = self._current_entry
+        source = self._source
 
         if self._current_player:
             self._current_player.after = None
@@ -209,24 +541,49 @@ class MusicPlayer(EventEmitter, Serializable):
 
         self._current_entry = None
         self._source = None
+        self._output = None
+
+        if self.playlist.journal:
+            self.playlist.journal.record("finish")
+
+        if entry:
+            entry.unpin()
 
         if error:
             self.stop()
             self.emit("error", player=self, entry=entry, ex=error)
             return
 
-        if self._stderr_future.done() and self._stderr_future.exception():
+        if source and source.stderr_future.done() and source.stderr_future.exception():
             # I'm not sure that this would ever not be done if it gets to this point
             # unless ffmpeg is doing something highly questionable
             self.stop()
             self.emit(
-                "error", player=self, entry=entry, ex=self._stderr_future.exception()
+                "error", player=self, entry=entry, ex=source.stderr_future.exception()
             )
             return
 
-        if not self.bot.config.save_videos and entry:
-            if not isinstance(entry, StreamPlaylistEntry):
-                if any([entry.filename == e.filename for e in self.playlist.entries]):
+        self._finish_entry(entry)
+
+    def _finish_entry(self, entry):
+        if entry and entry.playback_url:
+            # it was played while it downloaded, the file isn't there to delete yet
+            entry.stop_streaming().add_done_callback(
+                lambda task: self._delete_download(entry)
+            )
+        else:
+            self._delete_download(entry)
+
+        self.emit("finished-playing", player=self, entry=entry)
+
+    def _delete_download(self, entry):
+        if (
+            not self.bot.config.save_videos
+            and not self.bot.config.audio_cache_size
+            and entry
+        ):
+            if not isinstance(entry, StreamPlaylistEntry) and entry.filename:
+                if self.bot.downloader.audio_cache.is_pinned(entry.filename):
                     log.debug(
                         'Skipping deletion of "{}", found song in queue'.format(
                             entry.filename
@@ -241,6 +598,7 @@ class MusicPlayer(EventEmitter, Serializable):
                     for x in range(30):
                         try:
                             os.unlink(filename)
+                            self.bot.downloader.audio_cache.remove(filename)
                             log.debug("File deleted: {0}".format(filename))
                             break
                         except PermissionError as e:
@@ -271,9 +629,9 @@ class MusicPlayer(EventEmitter, Serializable):
                             )
                         )
 
-        self.emit("finished-playing", player=self, entry=entry)
-
     def _kill_current_player(self):
+        self._cancel_transition()
+
         if self._current_player:
             try:
                 self._current_player.stop()
@@ -291,6 +649,11 @@ class MusicPlayer(EventEmitter, Serializable):
         """
         Plays the next entry from the playlist, or resumes playback of the current entry if paused.
         """
+        if _continue and self._handoffs:
+            # the entry after the one that finished is already playing
+            self._handoffs -= 1
+            return
+
         if self.is_paused and self._current_player:
             return self.resume()
 
@@ -314,34 +677,24 @@ class MusicPlayer(EventEmitter, Serializable):
                 # In-case there was a player, kill it. RIP.
                 self._kill_current_player()
 
-                boptions = "-nostdin"
-                # aoptions = "-vn -b:a 192k"
-                if isinstance(entry, URLPlaylistEntry):
-                    aoptions = entry.aoptions
-                else:
-                    aoptions = "-vn"
+                start = 0
+                if self._resume_at and self._resume_at[0] is entry:
+                    start = self._resume_at[1]
+                    log.debug("Resuming {} at {:.2f}s".format(entry.title, start))
+                self._resume_at = None
 
-                log.ffmpeg(
-                    "Creating player with options: {} {} {}".format(
-                        boptions, aoptions, entry.filename
-                    )
-                )
-
-                self._source = SourcePlaybackCounter(
-                    PCMVolumeTransformer(
-                        FFmpegPCMAudio(
-                            entry.filename,
-                            before_options=boptions,
-                            options=aoptions,
-                            stderr=subprocess.PIPE,
-                        ),
-                        self.volume,
-                    )
+                passthrough = await self._can_passthrough(entry)
+                self._source = self._create_source(
+                    entry, passthrough=passthrough, start=start
                 )
+                self._output = TransitionSource(self._source, self._on_handoff)
                 log.debug(
                     "Playing {0} using {1}".format(self._source, self.voice_client)
                 )
-                self.voice_client.play(self._source, after=self._playback_finished)
+                self.voice_client.play(
+                    self._output,
+                    after=functools.partial(self._playback_finished, self._output),
+                )
 
                 self._current_player = self.voice_client
 
@@ -349,17 +702,220 @@ class MusicPlayer(EventEmitter, Serializable):
                 self.state = MusicPlayerState.PLAYING
                 self._current_entry = entry
 
-                self._stderr_future = asyncio.Future()
+                self.emit("play", player=self, entry=entry)
+                self._schedule_transition()
 
-                stderr_thread = Thread(
-                    target=filter_stderr,
-                    args=(self._source._source.original._process, self._stderr_future),
-                    name="stderr reader",
+    def _create_source(self, entry, *, passthrough=False, start=0):
+        """
+        Creates the audio source for `entry`, starting `start` seconds in.  A passthrough source hands the
+        file's opus packets to discord as they are, which skips decoding and re-encoding but can't change the volume.
+        """
+        boptions = "-nostdin"
+        filename = entry.filename
+        # aoptions = "-vn -b:a 192k"
+        if isinstance(entry, URLPlaylistEntry):
+            aoptions = entry.aoptions
+
+            if entry.playback_url:
+                # still downloading, play from where it's being downloaded from
+                filename = entry.playback_url
+                boptions += " " + entry.stream_options()
+        else:
+            aoptions = "-vn"
+
+        if start:
+            boptions += " -ss {:.2f}".format(start)
+
+        log.ffmpeg(
+            "Creating {} player with options: {} {} {}".format(
+                "passthrough" if passthrough else "pcm", boptions, aoptions, filename
+            )
+        )
+
+        if (
+            not passthrough
+            and self.bot.config.share_decoding
+            and isinstance(entry, URLPlaylistEntry)
+            and not entry.playback_url
+        ):
+            shared = self.bot.decoder_hub.subscribe(filename, aoptions, start)
+            # the decoder's stderr is read once for all of its subscribers
+            source = VolumeTransformer(shared, self.volume * entry.gain)
+            return SourcePlaybackCounter(source, start, shared.stderr_future)
+
+        stderr, stderr_future = self.bot.stderr_reader.open()
+        with stderr:
+            if passthrough:
+                source = FFmpegOpusAudio(
+                    filename,
+                    codec="copy",
+                    before_options=boptions,
+                    options=aoptions,
+                    stderr=stderr,
+                )
+            else:
+                source = VolumeTransformer(
+                    FFmpegPCMAudio(
+                        filename,
+                        before_options=boptions,
+                        options=aoptions,
+                        stderr=stderr,
+                    ),
+                    self.volume * entry.gain,
                 )
 
-                stderr_thread.start()
+        return SourcePlaybackCounter(source, start, stderr_future)
 
-                self.emit("play", player=self, entry=entry)
+    def _passthrough_ok(self, entry, volume):
+        return (
+            self.bot.config.opus_passthrough
+            and isinstance(entry, URLPlaylistEntry)
+            and not entry.playback_url
+            and entry.aoptions == "-vn"
+            and volume == 1
+            and entry.codec == "opus"
+        )
+
+    async def _can_passthrough(self, entry):
+        if not self.bot.config.opus_passthrough or not isinstance(
+            entry, URLPlaylistEntry
+        ):
+            return False
+
+        if entry.codec is None and entry.filename and not entry.playback_url:
+            try:
+                entry.codec, _ = await FFmpegOpusAudio.probe(entry.filename)
+            except Exception:
+                log.debug("Could not probe {}".format(entry.filename), exc_info=True)
+                entry.codec = ""
+
+        return self._passthrough_ok(entry, self.volume * entry.gain)
+
+    def seek(self, seconds):
+        """
+        Continues the current entry from `seconds` in.  ffmpeg is restarted with the position as an input option,
+        so it jumps there without decoding (or downloading, for songs that are still downloading) what's before it.
+        """
+        if not self._source or not (self.is_playing or self.is_paused):
+            raise ValueError("Cannot seek in state %s" % self.state)
+
+        if isinstance(self._current_entry, StreamPlaylistEntry):
+            raise ValueError("Cannot seek in a stream")
+
+        self._swap_source(self._source.is_opus(), start=max(0, seconds))
+
+    def _swap_source(self, passthrough, start=None):
+        """
+        Replaces the source of the playing entry with a passthrough or pcm one, picking up where it was unless
+        given a `start`.
+        """
+        # whatever was lined up next was timed against the old source
+        self._cancel_transition()
+
+        old = self._source
+        if start is None:
+            start = old.get_progress()
+
+        if not passthrough and not self.voice_client.encoder:
+            # the voice client only makes an encoder when it starts playing something that isn't opus
+            self.voice_client.encoder = opus.Encoder()
+
+        self._source = self._create_source(
+            self._current_entry, passthrough=passthrough, start=start
+        )
+        self._output.replace(self._source)
+
+        old.cleanup()
+        self._schedule_transition()
+
+    def _schedule_transition(self):
+        if self._transition_task:
+            self._transition_task.cancel()
+            self._transition_task = None
+
+        if self.bot.config.gapless_playback or self.bot.config.crossfade:
+            self._transition_task = self.loop.create_task(
+                self._prepare_transition(self._current_entry, self._output)
+            )
+
+    async def _prepare_transition(self, entry, output):
+        """
+        Lines the next entry up in the output shortly before `entry` ends, so it starts in the same frame as
+        `entry` ends in, or fades in over the last `Crossfade` milliseconds of it.
+        """
+        crossfade = self.bot.config.crossfade / 1000
+        if not entry or not entry.duration or isinstance(entry, StreamPlaylistEntry):
+            return
+
+        lead = crossfade + self.transition_lead
+        while entry.duration - self.progress > lead:
+            # progress stands still while paused, so keep checking rather than sleeping until the end
+            await asyncio.sleep(min(entry.duration - self.progress - lead, 5))
+            if self._current_entry is not entry or self._output is not output:
+                return
+
+        if self._source.is_opus() or isinstance(
+            self.playlist.peek(), StreamPlaylistEntry
+        ):
+            return
+
+        # only entries that are already downloaded, otherwise the usual way of waiting for it is as fast
+        next_entry = self.playlist.ready_entry()
+        if not next_entry:
+            return
+
+        source = self._create_source(next_entry)
+        fade_at = max(0, entry.duration - crossfade) if crossfade else None
+        if not output.queue(source, next_entry, fade_at, round(crossfade / 0.02)):
+            # the current entry ended while this was being set up
+            source.cleanup()
+            return
+
+        # it stays in the queue until it actually starts, so the queue looks the same until then
+        self.playlist.line_up(next_entry)
+        log.debug("Lined up {} after {}".format(next_entry.title, entry.title))
+
+    def _cancel_transition(self):
+        """
+        Takes back the entry that was lined up to play next, which is still at the front of the queue.
+        """
+        if self._transition_task:
+            self._transition_task.cancel()
+            self._transition_task = None
+
+        queued = self._output.unqueue() if self._output else None
+        if queued:
+            source, entry = queued
+            source.cleanup()
+            self.playlist.line_up(None)
+
+    def _on_handoff(self, output, old, new, entry):
+        # called from the audio thread
+        self.loop.call_soon_threadsafe(self._handed_off, output, old, new, entry)
+
+    def _handed_off(self, output, old, new, entry):
+        old.cleanup()
+
+        if output is not self._output:
+            # playback was stopped around the same time, the next entry is still in the queue to be played
+            new.cleanup()
+            return
+
+        self.playlist.take_lined_up(entry)
+        finished, self._current_entry = self._current_entry, entry
+        self._source = new
+
+        if finished:
+            finished.unpin()
+
+        log.debug("Handed off from {} to {}".format(finished.title, entry.title))
+
+        # the finished-playing handlers ask for the next entry to be played, which already is
+        self._handoffs += 1
+        self._finish_entry(finished)
+
+        self.emit("play", player=self, entry=entry)
+        self._schedule_transition()
 
     def __json__(self):
         return self._enclose_json(
@@ -367,7 +923,7 @@ class MusicPlayer(EventEmitter, Serializable):
                 "current_entry": {
                     "entry": self.current_entry,
                     "progress": self.progress,
-                    "progress_frames": self._current_player._player.loops
+                    "progress_frames": self._source.frames
                     if self.progress is not None
                     else None,
                 },
@@ -390,17 +946,22 @@ class MusicPlayer(EventEmitter, Serializable):
         current_entry_data = data["current_entry"]
         if current_entry_data["entry"]:
             player.playlist.entries.appendleft(current_entry_data["entry"])
-            # TODO: progress stuff
-            # how do I even do this
-            # this would have to be in the entry class right?
-            # some sort of progress indicator to skip ahead with ffmpeg (however that works, reading and ignoring frames?)
+
+            # live streams can't be seeked, they just carry on from wherever they are now
+            progress = current_entry_data.get("progress")
+            if progress and not isinstance(
+                current_entry_data["entry"], StreamPlaylistEntry
+            ):
+                player._resume_at = (current_entry_data["entry"], progress)
 
         return player
 
     @classmethod
     def from_json(cls, raw_json, bot, voice_client, playlist):
         try:
-            return json.loads(raw_json, object_hook=Serializer.deserialize)
+            return Serializer.loads(
+                raw_json, bot=bot, voice_client=voice_client, playlist=playlist
+            )
         except Exception as e:
             log.exception("Failed to deserialize player", e)
 
@@ -428,52 +989,130 @@ class MusicPlayer(EventEmitter, Serializable):
     def progress(self):
         if self._source:
             return self._source.get_progress()
-            # TODO: Properly implement this
-            #       Correct calculation should be bytes_read/192k
-            #       192k AKA sampleRate * (bitDepth / 8) * channelCount
-            #       Change frame_count to bytes_read in the PatchedBuff
 
 
 # TODO: I need to add a check for if the eventloop is closed
 
 
-def filter_stderr(popen: subprocess.Popen, future: asyncio.Future):
-    last_ex = None
+class StderrMultiplexer:
+    """
+    Reads the stderr of every ffmpeg process the bot runs from the event loop, instead of from a thread per
+    process.  Each process writes to a pipe from `open`, whose future is resolved once the process exits, with
+    the last error ffmpeg printed if there was one.
 
-    while True:
-        data = popen.stderr.readline()
-        if data:
-            log.ffmpeg("Data from ffmpeg: {}".format(data))
+    Event loops that can't watch pipes (the proactor loop on Windows) get a thread per pipe like before.
+    """
+
+    def __init__(self, loop, classifier):
+        self.loop = loop
+        self.classifier = classifier
+        self._pipes = {}
+        self._threaded = False
+
+    def open(self):
+        """
+        Returns a file to pass as ffmpeg's stderr, to be closed once ffmpeg was started, and its future.
+        """
+        fd, write_fd = os.pipe()
+        future = self.loop.create_future()
+        self._pipes[fd] = [future, b"", None]  # future, unfinished line, last error
+
+        if not self._threaded:
             try:
-                if check_stderr(data):
-                    sys.stderr.buffer.write(data)
-                    sys.stderr.buffer.flush()
+                self.loop.add_reader(fd, self._read, fd)
+                os.set_blocking(fd, False)
+            except NotImplementedError:
+                self._threaded = True
 
-            except FFmpegError as e:
-                log.ffmpeg("Error from ffmpeg: %s", str(e).strip())
-                last_ex = e
+        if self._threaded:
+            Thread(
+                target=self._read_blocking, args=(fd,), name="stderr reader", daemon=True
+            ).start()
 
-            except FFmpegWarning:
-                pass  # useless message
-        else:
-            break
+        return os.fdopen(write_fd, "wb"), future
+
+    def _read(self, fd):
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
 
-    if last_ex:
-        future.set_exception(last_ex)
-    else:
-        future.set_result(True)
+        self._received(fd, data)
 
+    def _read_blocking(self, fd):
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                data = b""
+
+            self.loop.call_soon_threadsafe(self._received, fd, data)
+            if not data:
+                return
+
+    def _received(self, fd, data):
+        pipe = self._pipes[fd]
+        *lines, pipe[1] = (pipe[1] + data).split(b"\n")
+
+        if not data:
+            lines.append(pipe[1])
+            self._close(fd)
+
+        for line in lines:
+            if line:
+                pipe[2] = self._filter(line) or pipe[2]
+
+        if not data:
+            future, _, last_ex = pipe
+            if future.done():
+                return
+            if last_ex:
+                future.set_exception(last_ex)
+            else:
+                future.set_result(True)
+
+    def _filter(self, data):
+        """
+        Echoes a line ffmpeg printed unless it's a useless warning.  Returns the error if the line is one.
+        """
+        kind = self.classifier.classify(data)
+        if kind is FFmpegWarning:
+            return
+
+        text = data.decode("utf8", "replace")
+        log.ffmpeg("Data from ffmpeg: {}".format(text))
+
+        if kind is FFmpegError:
+            log.ffmpeg("Error from ffmpeg: %s", text.strip())
+            return FFmpegError(text)
 
-def check_stderr(data: bytes):
-    try:
-        data = data.decode("utf8")
-    except:
-        log.ffmpeg("Unknown error decoding message from ffmpeg", exc_info=True)
-        return True  # fuck it
+        sys.stderr.buffer.write(data + b"\n")
+        sys.stderr.buffer.flush()
 
-    # log.ffmpeg("Decoded data from ffmpeg: {}".format(data))
+    def _close(self, fd):
+        self._pipes.pop(fd)
+        if not self._threaded:
+            self.loop.remove_reader(fd)
+        os.close(fd)
+
+    @property
+    def stats(self):
+        return dict(
+            self.classifier.stats, pipes=len(self._pipes), threaded=self._threaded
+        )
+
+
+class StderrClassifier:
+    """
+    Sorts the lines ffmpeg prints into useless warnings, errors and everything else, and every pattern counts how
+    many lines it matched.  The built-in patterns are plain text and combined into a single regex, so a line is
+    scanned once for all of them.  Extra patterns are regular expressions from the config, which can have inline
+    flags or backreferences that would break or change meaning in a combined regex, so they're matched one by
+    one, before the built-in ones.
+    """
 
-    # TODO: Regex
     warnings = [
         "Header missing",
         "Estimating duration from birate, this may be inaccurate",
@@ -487,13 +1126,61 @@ def check_stderr(data: bytes):
         "Invalid data found when processing input",  # need to regex this properly, its both a warning and an error
     ]
 
-    if any(msg in data for msg in warnings):
-        raise FFmpegWarning(data)
+    def __init__(self, warnings=(), errors=()):
+        # (kind, name shown in the stats), the extra patterns first
+        self.patterns = [(FFmpegError, p) for p in errors]
+        self.patterns += [(FFmpegWarning, p) for p in warnings]
+        self._extra = [self.compile(p) for p in (*errors, *warnings)]
+
+        builtin = [(FFmpegWarning, m) for m in self.warnings]
+        builtin += [(FFmpegError, m) for m in self.errors]
+        # lines are matched as they come from ffmpeg, only the ones that are shown get decoded
+        self._regex = re.compile(
+            b"|".join(
+                b"(?P<p%d>%s)" % (i, re.escape(message.encode("utf8")))
+                for i, (_, message) in enumerate(builtin, len(self.patterns))
+            )
+        )
+        self.patterns += builtin
 
-    if any(msg in data for msg in errors):
-        raise FFmpegError(data)
+        self.counts = [0] * len(self.patterns)
+        self.lines = 0
 
-    return True
+    @staticmethod
+    def compile(pattern):
+        """
+        Compiles an extra pattern the way it's matched, raising re.error if it's invalid.
+        """
+        return re.compile(pattern.encode("utf8"))
+
+    def classify(self, data: bytes):
+        """
+        Returns FFmpegWarning or FFmpegError if `data` matches one of their patterns, otherwise None.
+        """
+        self.lines += 1
+
+        for i, regex in enumerate(self._extra):
+            if regex.search(data):
+                break
+        else:
+            match = self._regex.search(data)
+            if not match:
+                return None
+            i = int(match.lastgroup[1:])
+
+        self.counts[i] += 1
+        return self.patterns[i][0]
+
+    @property
+    def stats(self):
+        return {
+            "lines": self.lines,
+            "matches": {
+                name: count
+                for (_, name), count in zip(self.patterns, self.counts)
+                if count
+            },
+        }
 
 
 # if redistributing ffmpeg is an issue, it can be downloaded from here:
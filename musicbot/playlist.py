@@ -1,10 +1,9 @@
 import os.path
+import asyncio
 import logging
 import datetime
 
-from random import shuffle
 from itertools import islice
-from collections import deque
 from urllib.error import URLError
 
 # For the time being, youtube_dl is often slow and inconsistent
@@ -14,12 +13,21 @@ from yt_dlp.utils import ExtractorError, DownloadError, UnsupportedError
 from .utils import get_header
 from .constructs import Serializable
 from .lib.event_emitter import EventEmitter
+from .lib.indexed_deque import IndexedDeque
 from .entry import URLPlaylistEntry, StreamPlaylistEntry
 from .exceptions import ExtractionError, WrongEntryTypeError, InvalidDataError
 
 log = logging.getLogger(__name__)
 
 
+def _author(entry):
+    return entry.meta.get("author", None)
+
+
+def _duration(entry):
+    return entry.duration
+
+
 class Playlist(EventEmitter, Serializable):
     """
     A playlist is manages the list of songs that will be played.
@@ -30,7 +38,10 @@ class Playlist(EventEmitter, Serializable):
         self.bot = bot
         self.loop = bot.loop
         self.downloader = bot.downloader
-        self.entries = deque()
+        self.entries = IndexedDeque(key=_author, weight=_duration)
+        self._prefetching = set()
+        self._lined_up = None
+        self.journal = None
 
     def __iter__(self):
         return iter(self.entries)
@@ -39,41 +50,66 @@ class Playlist(EventEmitter, Serializable):
         return len(self.entries)
 
     def shuffle(self):
-        shuffle(self.entries)
+        if self.journal:
+            positions = {id(entry): i for i, entry in enumerate(self.entries)}
+
+        self.entries.shuffle()
+
+        if self.journal:
+            self._record(
+                "order", order=[positions[id(entry)] for entry in self.entries]
+            )
+        self._prefetch()
 
     def clear(self):
+        for entry in self.entries:
+            entry.unpin()
+
         self.entries.clear()
+        self._record("clear")
+        self._prefetch()
+
+    def remove(self, entry):
+        """
+        Removes `entry` from the playlist, raising ValueError if it isn't queued.
+        """
+        index = self.entries.index(entry)
+        del self.entries[index]
+        self._record("remove", index=index)
+        entry.unpin()
+        self._prefetch()
 
     def get_entry_at_index(self, index):
-        self.entries.rotate(-index)
-        entry = self.entries[0]
-        self.entries.rotate(index)
-        return entry
+        return self.entries[index]
 
     def delete_entry_at_index(self, index):
-        self.entries.rotate(-index)
-        entry = self.entries.popleft()
-        self.entries.rotate(index)
+        entry = self.entries[index]
+        del self.entries[index]
+        self._record("remove", index=index)
+        entry.unpin()
+        self._prefetch()
         return entry
 
-    async def add_entry(self, song_url, *, head, **meta):
+    async def add_entry(self, song_url, *, head, info=None, **meta):
         """
         Validates and adds a song_url to be played. This does not start the download of the song.
 
         Returns the entry & the position it is in the queue.
 
         :param song_url: The song url to add to the playlist.
+        :param info: The processed info of song_url, if the caller already looked it up.
         :param meta: Any additional metadata to add to the playlist entry.
         """
 
-        try:
-            info = await self.downloader.extract_info(
-                self.loop, song_url, download=False
-            )
-        except Exception as e:
-            raise ExtractionError(
-                "Could not extract information from {}\n\n{}".format(song_url, e)
-            )
+        if info is None:
+            try:
+                info = await self.downloader.extract_info(
+                    self.loop, song_url, download=False
+                )
+            except Exception as e:
+                raise ExtractionError(
+                    "Could not extract information from {}\n\n{}".format(song_url, e)
+                )
 
         if not info:
             raise ExtractionError("Could not extract information from %s" % song_url)
@@ -137,6 +173,8 @@ class Playlist(EventEmitter, Serializable):
             self.downloader.ytdl.prepare_filename(info),
             **meta
         )
+        entry.filesize = info.get("filesize") or info.get("filesize_approx")
+        entry.remember_stream(info)
         self._add_entry(entry, head=head)
         return entry, (1 if head else len(self.entries))
 
@@ -249,6 +287,9 @@ class Playlist(EventEmitter, Serializable):
                         self.downloader.ytdl.prepare_filename(item),
                         **meta
                     )
+                    entry.filesize = item.get("filesize") or item.get(
+                        "filesize_approx"
+                    )
 
                     self._add_entry(entry, head=head)
                     entry_list.append(entry)
@@ -266,11 +307,14 @@ class Playlist(EventEmitter, Serializable):
             entry_list.reverse()
         return entry_list, position
 
-    async def async_process_youtube_playlist(self, playlist_url, *, head, **meta):
+    async def async_process_youtube_playlist(
+        self, playlist_url, *, head=False, progress_callback=None, **meta
+    ):
         """
         Processes youtube playlists links from `playlist_url` in a questionable, async fashion.
 
         :param playlist_url: The playlist url to be cut into individual urls and added to the playlist
+        :param progress_callback: Called with the number of processed songs and the total after each song
         :param meta: Any additional metadata to add to the playlist entry
         """
 
@@ -288,44 +332,24 @@ class Playlist(EventEmitter, Serializable):
                 "Could not extract information from %s" % playlist_url
             )
 
-        gooditems = []
-        baditems = 0
-
-        entries = list(info["entries"])
-        if head:
-            entries.reverse()
-        for entry_data in info["entries"]:
-            if entry_data:
-                baseurl = info["webpage_url"].split("playlist?list=")[0]
-                song_url = baseurl + "watch?v=%s" % entry_data["id"]
-
-                try:
-                    entry, elen = await self.add_entry(song_url, head=head, **meta)
-                    gooditems.append(entry)
-
-                except ExtractionError:
-                    baditems += 1
-
-                except Exception as e:
-                    baditems += 1
-                    log.error(
-                        "Error adding entry {}".format(entry_data["id"]), exc_info=e
-                    )
-            else:
-                baditems += 1
+        baseurl = info["webpage_url"].split("playlist?list=")[0]
+        song_urls = [
+            baseurl + "watch?v=%s" % entry_data["id"] if entry_data else None
+            for entry_data in info["entries"]
+        ]
 
-        if baditems:
-            log.info("Skipped {} bad entries".format(baditems))
-
-        if head:
-            gooditems.reverse()
-        return gooditems
+        return await self._expand_playlist(
+            song_urls, head=head, progress_callback=progress_callback, **meta
+        )
 
-    async def async_process_sc_bc_playlist(self, playlist_url, *, head=False, **meta):
+    async def async_process_sc_bc_playlist(
+        self, playlist_url, *, head=False, progress_callback=None, **meta
+    ):
         """
         Processes soundcloud set and bancdamp album links from `playlist_url` in a questionable, async fashion.
 
         :param playlist_url: The playlist url to be cut into individual urls and added to the playlist
+        :param progress_callback: Called with the number of processed songs and the total after each song
         :param meta: Any additional metadata to add to the playlist entry
         """
 
@@ -343,30 +367,77 @@ class Playlist(EventEmitter, Serializable):
                 "Could not extract information from %s" % playlist_url
             )
 
-        gooditems = []
-        baditems = 0
+        song_urls = [
+            entry_data["url"] if entry_data else None for entry_data in info["entries"]
+        ]
 
-        entries = list(info["entries"])
+        return await self._expand_playlist(
+            song_urls, head=head, progress_callback=progress_callback, **meta
+        )
+
+    async def _expand_playlist(self, song_urls, *, head, progress_callback=None, **meta):
+        """
+        Looks up `song_urls` concurrently, at most `PlaylistConcurrency` at a time, and adds each one to the
+        playlist as soon as every song before it is done, so the songs keep their original order.
+
+        Returns the list of entries that were added.
+        """
         if head:
-            entries.reverse()
-        for entry_data in info["entries"]:
-            if entry_data:
-                song_url = entry_data["url"]
+            # every entry gets put in front of the last, so add them back to front
+            song_urls = song_urls[::-1]
 
-                try:
-                    entry, elen = await self.add_entry(song_url, head=head, **meta)
-                    gooditems.append(entry)
+        semaphore = asyncio.Semaphore(self.bot.config.playlist_concurrency)
 
-                except ExtractionError:
-                    baditems += 1
+        async def lookup(song_url):
+            async with semaphore:
+                return await self.downloader.extract_info(
+                    self.loop, song_url, download=False
+                )
 
-                except Exception as e:
+        lookups = [
+            asyncio.ensure_future(lookup(song_url)) if song_url else None
+            for song_url in song_urls
+        ]
+
+        gooditems = []
+        baditems = 0
+
+        try:
+            for processed, (song_url, pending) in enumerate(zip(song_urls, lookups), 1):
+                if pending is None:
                     baditems += 1
-                    log.error(
-                        "Error adding entry {}".format(entry_data["id"]), exc_info=e
-                    )
-            else:
-                baditems += 1
+
+                else:
+                    try:
+                        info = await pending
+                        if not info:
+                            raise ExtractionError(
+                                "Could not extract information from %s" % song_url
+                            )
+
+                        entry, elen = await self.add_entry(
+                            song_url, head=head, info=info, **meta
+                        )
+                        gooditems.append(entry)
+
+                    except (ExtractionError, ExtractorError, DownloadError) as e:
+                        baditems += 1
+                        log.debug("Could not add {}: {}".format(song_url, e))
+
+                    except Exception as e:
+                        baditems += 1
+                        log.error("Error adding entry {}".format(song_url), exc_info=e)
+
+                if progress_callback:
+                    if asyncio.iscoroutinefunction(progress_callback):
+                        await progress_callback(processed, len(song_urls))
+                    else:
+                        progress_callback(processed, len(song_urls))
+
+        finally:
+            for pending in lookups:
+                if pending and not pending.done():
+                    pending.cancel()
 
         if baditems:
             log.info("Skipped {} bad entries".format(baditems))
@@ -381,33 +452,108 @@ class Playlist(EventEmitter, Serializable):
         else:
             self.entries.append(entry)
 
+        self._record("add", entry=entry, head=head)
         self.emit("entry-added", playlist=self, entry=entry)
-
-        if self.peek() is entry:
-            entry.get_ready_future()
+        self._prefetch()
 
     def remove_entry(self, index):
+        self.entries[index].unpin()
         del self.entries[index]
+        self._record("remove", index=index)
+        self._prefetch()
+
+    def _record(self, op, **data):
+        """
+        Writes a change to the queue to the persistent queue's journal, if there is one.
+        """
+        if self.journal:
+            self.journal.record(op, **data)
+
+    def _prefetch(self):
+        """
+        Starts downloading the entries at the front of the queue, as many as PrefetchSongs allows and as long as
+        they fit in PrefetchSizeLimit.  Prefetches of entries that got removed or shuffled out of that window
+        are cancelled.
+        """
+        self._check_lined_up()
+
+        budget = self.bot.config.prefetch_size_limit * 1024 * 1024
+        window = set()
+
+        for entry in islice(self.entries, self.bot.config.prefetch_songs):
+            size = entry.estimated_size
+            # always prefetch the next entry, no matter how big it is
+            if window and size > budget:
+                break
+
+            budget -= size
+            # the first entry is the one that plays next, the rest are looked ahead to
+            entry.prefetch(lookahead=bool(window))
+            window.add(entry)
+
+        for entry in self._prefetching - window:
+            entry.cancel_prefetch()
+
+        self._prefetching = window
 
     async def get_next_entry(self, predownload_next=True):
         """
         A coroutine which will return the next song or None if no songs left to play.
 
         Additionally, if predownload_next is set to True, it will attempt to download the next
-        song to be played - so that it's ready by the time we get to it.
+        few songs to be played - so that they're ready by the time we get to them.
         """
         if not self.entries:
             return None
 
         entry = self.entries.popleft()
+        self._record("pop", entry=entry)
+        self._prefetching.discard(entry)
+        self._check_lined_up()
 
         if predownload_next:
-            next_entry = self.peek()
-            if next_entry:
-                next_entry.get_ready_future()
+            self._prefetch()
 
         return await entry.get_ready_future()
 
+    def ready_entry(self):
+        """
+        Returns the next entry if it's downloaded and can be played right away, leaving it in the queue.
+        """
+        entry = self.peek()
+        if entry and entry.is_downloaded:
+            return entry
+
+    def line_up(self, entry):
+        """
+        Marks the next entry as lined up to start the moment the current one ends, or nothing with None.  If it
+        stops being the next entry before `take_lined_up`, "lined-up-changed" is emitted.
+        """
+        self._lined_up = entry
+
+    def take_lined_up(self, entry):
+        """
+        Takes `entry` out of the queue now that it has started playing after being lined up.
+        """
+        self._lined_up = None
+
+        if self.peek() is entry:
+            self.entries.popleft()
+            self._record("pop", entry=entry)
+        elif entry in self.entries:
+            # the queue changed while it was being handed off, it's playing now anyway
+            index = self.entries.index(entry)
+            del self.entries[index]
+            self._record("pop", entry=entry, index=index)
+
+        self._prefetching.discard(entry)
+        self._prefetch()
+
+    def _check_lined_up(self):
+        if self._lined_up is not None and self.peek() is not self._lined_up:
+            self._lined_up = None
+            self.emit("lined-up-changed", playlist=self)
+
     def peek(self):
         """
         Returns the next entry that should be scheduled to be played.
@@ -419,10 +565,9 @@ class Playlist(EventEmitter, Serializable):
         """
         (very) Roughly estimates the time till the queue will 'position'
         """
-        if any(e.duration == None for e in islice(self.entries, position - 1)):
+        estimated_time, unknown = self.entries.weight_before(position - 1)
+        if unknown:
             raise InvalidDataError("no duration data")
-        else:
-            estimated_time = sum(e.duration for e in islice(self.entries, position - 1))
 
         # When the player plays a song, it eats the first playlist item, so we just have to add the time back
         if not player.is_stopped and player.current_entry:
@@ -434,7 +579,25 @@ class Playlist(EventEmitter, Serializable):
         return datetime.timedelta(seconds=estimated_time)
 
     def count_for_user(self, user):
-        return sum(1 for e in self.entries if e.meta.get("author", None) == user)
+        return self.entries.count_key(user)
+
+    def duration_for_user(self, user):
+        """
+        Returns the total duration of the entries queued by `user`, and how many of them have no known duration.
+        """
+        return self.entries.key_weight(user)
+
+    def duration_changed(self, entry):
+        """
+        Updates the queue's duration totals after `entry` found out its duration.
+        """
+        self.entries.reweigh(entry)
+
+    def entries_for_user(self, user):
+        """
+        Returns the queued entries added by `user`, in no particular order.
+        """
+        return self.entries.with_key(user)
 
     def __json__(self):
         return self._enclose_json({"entries": list(self.entries)})
@@ -446,7 +609,9 @@ class Playlist(EventEmitter, Serializable):
         pl = cls(bot)
 
         for entry in raw_json["entries"]:
-            pl.entries.append(entry)
+            # entries that couldn't be loaded come back as None
+            if entry is not None:
+                pl.entries.append(entry)
 
         # TODO: create a function to init downloading (since we don't do it here)?
         return pl
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# musicbot refuses to let anything import requests, which dependencies that only use it when it's installed
+# (yt-dlp does) don't expect.  Marking it as not installed makes them fall back like it isn't.
+sys.modules.setdefault("requests", None)
+
+# importing musicbot starts logging to logs/musicbot.log, run.py makes that folder before it does
+os.chdir(tempfile.mkdtemp(prefix="musicbot-tests-"))
+os.mkdir("logs")
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import threading
+import types
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from musicbot.audiocache import AudioCache
+from musicbot.entry import URLPlaylistEntry
+
+
+class Downloader:
+    """
+    Downloads in a thread that waits for `release`, like a yt-dlp download that's already running.
+    """
+
+    def __init__(self, folder):
+        self.download_folder = folder
+        self.audio_cache = AudioCache(folder, folder + ".sqlite")
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.downloads = 0
+        self.pool = ThreadPoolExecutor(2)
+        self.ytdl = types.SimpleNamespace(
+            prepare_filename=lambda info: os.path.join(folder, info["name"])
+        )
+
+    def download(self):
+        self.downloads += 1
+        self.started.set()
+        self.release.wait(5)
+        with open(os.path.join(self.download_folder, "youtube-x.m4a"), "wb") as f:
+            f.write(b"\0" * 100)
+        return {"name": "youtube-x.m4a"}
+
+    async def extract_info(self, loop, url, *, download, prefetch):
+        future = self.pool.submit(self.download)
+        prefetch.downloads.append(future)
+        return await asyncio.wrap_future(future)
+
+
+def make_entry(folder, **config):
+    defaults = dict(
+        save_videos=False,
+        audio_cache_size=0,
+        progressive_playback=False,
+        use_experimental_equalization=False,
+    )
+    config = types.SimpleNamespace(**dict(defaults, **config))
+    playlist = types.SimpleNamespace(
+        loop=asyncio.get_running_loop(),
+        downloader=Downloader(folder),
+        bot=types.SimpleNamespace(config=config),
+        entries=[],
+    )
+    entry = URLPlaylistEntry(
+        playlist,
+        "https://www.youtube.com/watch?v=x",
+        "x",
+        60,
+        os.path.join(folder, "youtube-x.m4a"),
+    )
+    playlist.entries.append(entry)
+    return entry
+
+
+async def cancel_running(entry):
+    downloader = entry.playlist.downloader
+    entry.prefetch()
+    while not downloader.started.is_set():
+        await asyncio.sleep(0.01)
+
+    entry.playlist.entries.remove(entry)
+    entry.cancel_prefetch()
+    await asyncio.sleep(0.01)
+    assert not entry.is_downloaded
+
+
+async def until(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+@pytest.fixture
+def folder(tmp_path):
+    return str(tmp_path / "audio_cache")
+
+
+def test_cancelled_download_is_deleted(folder):
+    path = os.path.join(folder, "youtube-x.m4a")
+
+    async def run():
+        entry = make_entry(folder)
+        await cancel_running(entry)
+        entry.playlist.downloader.release.set()
+        await until(lambda: entry._abandoned_download is None)
+        return entry
+
+    entry = asyncio.run(run())
+    assert not os.path.exists(path)
+    assert entry.playlist.downloader.audio_cache.size == 0
+
+
+def test_cancelled_download_is_cached(folder):
+    async def run():
+        entry = make_entry(folder, audio_cache_size=10 ** 6)
+        audio_cache = entry.playlist.downloader.audio_cache
+        await cancel_running(entry)
+        entry.playlist.downloader.release.set()
+        await until(lambda: audio_cache.size)
+        return await audio_cache.find(entry.playlist.loop, "youtube-x.m4a")
+
+    cached = asyncio.run(run())
+    assert os.path.exists(os.path.join(folder, "youtube-x.m4a"))
+    assert cached.size == 100
+    assert cached.duration == 60
+
+
+def test_downloading_again_waits_for_cancelled_download(folder):
+    async def run():
+        entry = make_entry(folder)
+        await cancel_running(entry)
+
+        entry.playlist.entries.append(entry)
+        ready = entry.get_ready_future()
+        await asyncio.sleep(0.01)
+        entry.playlist.downloader.release.set()
+        await asyncio.wait_for(ready, 5)
+        return entry
+
+    entry = asyncio.run(run())
+    assert entry.is_downloaded
+    assert entry.playlist.downloader.downloads == 1
+    assert os.path.exists(entry.filename)
@@ -0,0 +1,134 @@
+import random
+
+import pytest
+
+from musicbot.lib.indexed_deque import IndexedDeque
+
+
+class Item:
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+
+    def __repr__(self):
+        return "Item({!r}, {!r})".format(self.key, self.weight)
+
+
+def make(items=(), block_size=4):
+    return IndexedDeque(
+        items,
+        key=lambda item: item.key,
+        weight=lambda item: item.weight,
+        block_size=block_size,
+    )
+
+
+def random_item(rng):
+    return Item(rng.choice("abc"), rng.choice([None, 0, 1, 2.5, 7]))
+
+
+def weight_of(items):
+    known = sum(item.weight for item in items if item.weight is not None)
+    return known, sum(1 for item in items if item.weight is None)
+
+
+def check(deque, model):
+    assert len(deque) == len(model)
+    assert list(deque) == model
+    assert list(reversed(deque)) == model[::-1]
+
+    for i, item in enumerate(model):
+        assert deque[i] is item
+        assert deque[i - len(model)] is item
+        assert deque.index(item) == i
+        assert item in deque
+
+    for index in range(len(model) + 2):
+        assert deque.weight_before(index) == weight_of(model[:index])
+    assert deque.total_weight == weight_of(model)
+
+    for key in "abc":
+        with_key = [item for item in model if item.key == key]
+        assert deque.count_key(key) == len(with_key)
+        assert sorted(map(id, deque.with_key(key))) == sorted(map(id, with_key))
+        assert deque.key_weight(key) == weight_of(with_key)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_list(seed):
+    rng = random.Random(seed)
+    deque, model = make(), []
+
+    for step in range(400):
+        action = rng.random()
+        if action < 0.3:
+            item = random_item(rng)
+            deque.append(item)
+            model.append(item)
+        elif action < 0.5:
+            item = random_item(rng)
+            deque.appendleft(item)
+            model.insert(0, item)
+        elif action < 0.6 and model:
+            assert deque.pop() is model.pop()
+        elif action < 0.7 and model:
+            assert deque.popleft() is model.pop(0)
+        elif action < 0.8 and model:
+            index = rng.randrange(-len(model), len(model))
+            del deque[index]
+            del model[index]
+        elif action < 0.9 and model:
+            item = rng.choice(model)
+            deque.remove(item)
+            model.remove(item)
+        elif action < 0.97 and model:
+            item = rng.choice(model)
+            item.weight = rng.choice([None, 0, 3, 4.5])
+            deque.reweigh(item)
+        else:
+            deque.shuffle()
+            model = list(deque)
+
+        check(deque, model)
+
+
+def test_slices():
+    items = [Item("a", i) for i in range(10)]
+    deque = make(items, block_size=3)
+
+    assert deque[2:7] == items[2:7]
+    assert deque[::-2] == items[::-2]
+    assert deque[-3:] == items[-3:]
+
+
+def test_errors():
+    item = Item("a", 1)
+    deque = make([item])
+
+    with pytest.raises(IndexError):
+        deque[1]
+    with pytest.raises(IndexError):
+        deque[-2]
+    with pytest.raises(ValueError):
+        deque.append(item)
+    with pytest.raises(ValueError):
+        deque.appendleft(item)
+    # a rejected item doesn't end up in the deque anyway
+    assert len(deque) == 1 and list(deque) == [item]
+    with pytest.raises(ValueError):
+        deque.remove(Item("a", 1))
+    with pytest.raises(ValueError):
+        deque.index(Item("a", 1))
+
+    deque.clear()
+    with pytest.raises(IndexError):
+        deque.pop()
+    with pytest.raises(IndexError):
+        deque.popleft()
+    assert deque.key_weight("a") == (0, 0)
+
+
+def test_reweigh_ignores_missing_items():
+    deque = make([Item("a", 1)])
+    deque.reweigh(Item("a", 5))
+    assert deque.total_weight == (1, 0)
@@ -0,0 +1,258 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+from musicbot.journal import QueueJournal
+from musicbot.playlist import Playlist
+
+
+class Entry:
+    def __init__(self, n):
+        self.n = n
+        self.meta = {}
+        self.duration = 1
+        self.is_downloaded = True
+
+    def __json__(self):
+        return {"n": self.n}
+
+    def unpin(self):
+        pass
+
+    def cancel_prefetch(self):
+        pass
+
+
+class Config:
+    prefetch_songs = 0
+    prefetch_size_limit = 0
+
+
+class Bot:
+    loop = None
+    downloader = None
+    config = Config()
+
+
+class Player:
+    """
+    Stands in for MusicPlayer, serialized the way it is but without its entries having to be real ones.
+    """
+
+    def __init__(self):
+        self.playlist = Playlist(Bot())
+        self.current_entry = None
+
+    def __json__(self):
+        return {
+            "__class__": "MusicPlayer",
+            "__module__": "musicbot.player",
+            "data": {
+                "current_entry": {
+                    "entry": self.current_entry,
+                    "progress": None,
+                    "progress_frames": None,
+                },
+                "entries": {
+                    "__class__": "Playlist",
+                    "__module__": "musicbot.playlist",
+                    "data": {"entries": list(self.playlist.entries)},
+                },
+            },
+        }
+
+    def saved(self):
+        return json.loads(json.dumps(self.__json__()["data"], default=Entry.__json__))
+
+
+def loaded(path):
+    return json.loads(QueueJournal(path).load())["data"]
+
+
+def queued(data):
+    return [entry["n"] for entry in data["entries"]["data"]["entries"]]
+
+
+def current(data):
+    entry = data["current_entry"]["entry"]
+    return entry and entry["n"]
+
+
+@pytest.fixture(autouse=True)
+def loop():
+    # playlists take the event loop they're made on
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "queue.json")
+
+
+def start(path, entries=(), **kwargs):
+    player = Player()
+    player.playlist.entries.extend(Entry(n) for n in entries)
+    journal = QueueJournal(path, **kwargs)
+    journal.attach(player)
+    return player, journal
+
+
+def take(player):
+    entry = player.playlist.ready_entry()
+    player.playlist.line_up(entry)
+    player.playlist.take_lined_up(entry)
+    player.current_entry = entry
+
+
+def test_nothing_saved(path):
+    assert QueueJournal(path).load() is None
+
+
+def test_replays_changes(path):
+    player, journal = start(path, [1, 2, 3], compact_after=1000)
+    player.playlist._add_entry(Entry(4), head=False)
+    player.playlist._add_entry(Entry(0), head=True)
+    player.playlist.delete_entry_at_index(2)
+    take(player)
+
+    assert journal.generation == 1 and journal.ops == 4
+    data = loaded(path)
+    assert queued(data) == [1, 3, 4]
+    assert current(data) == 0
+    assert data == player.saved()
+
+
+def test_compaction_empties_journal(path):
+    player, journal = start(path, compact_after=3)
+    for n in range(7):
+        player.playlist._add_entry(Entry(n), head=False)
+
+    assert journal.generation == 3
+    with open(journal.journal_path, encoding="utf8") as f:
+        assert len(f.read().splitlines()) == 2
+    assert queued(loaded(path)) == list(range(7))
+
+
+def test_finish_forgets_current(path):
+    # the last song finished and nothing was taken after it, so there's nothing to play after a restart
+    player, journal = start(path, [1], compact_after=1000)
+    take(player)
+    player.current_entry = None
+    journal.record("finish")
+
+    assert current(loaded(path)) is None
+
+    journal.compact()
+    journal.write(journal.take())
+    data = loaded(path)
+    assert current(data) is None
+    assert data == player.saved()
+
+
+def test_snapshot_keeps_entry_not_started_yet(path):
+    player, journal = start(path, [1, 2], compact_after=1000)
+    take(player)
+    player.current_entry = None
+    journal.compact()
+    journal.write(journal.take())
+
+    data = loaded(path)
+    assert current(data) == 1
+    assert queued(data) == [2]
+
+
+def test_lined_up_entry_moved(path):
+    # an entry was put in front of the lined up one before it started playing
+    player, journal = start(path, [1, 2], compact_after=1000)
+    lined_up = player.playlist.ready_entry()
+    player.playlist.line_up(lined_up)
+    player.playlist._add_entry(Entry(0), head=True)
+    player.playlist.take_lined_up(lined_up)
+    player.current_entry = lined_up
+
+    data = loaded(path)
+    assert current(data) == 1
+    assert queued(data) == [0, 2]
+    assert data == player.saved()
+
+    journal.compact()
+    journal.write(journal.take())
+    assert loaded(path) == player.saved()
+
+
+def test_stop_forgets_current(path):
+    player, journal = start(path, [1, 2], compact_after=1000)
+    take(player)
+    player.current_entry = None
+    journal.record("stop")
+
+    data = loaded(path)
+    assert queued(data) == [2]
+    assert current(data) is None
+
+
+def test_stops_at_torn_line(path):
+    player, journal = start(path, [1], compact_after=1000)
+    player.playlist._add_entry(Entry(2), head=False)
+    player.playlist._add_entry(Entry(3), head=False)
+
+    with open(journal.journal_path, "r+", encoding="utf8") as f:
+        text = f.read()
+        f.seek(0)
+        f.truncate()
+        f.write(text[:-5])
+
+    assert queued(loaded(path)) == [1, 2]
+
+
+def test_ignores_journal_of_older_snapshot(path):
+    player, journal = start(path, [1], compact_after=1000)
+    player.playlist._add_entry(Entry(2), head=False)
+
+    with open(journal.journal_path, encoding="utf8") as f:
+        stale = f.read()
+
+    journal.compact()
+    player.playlist._add_entry(Entry(3), head=False)
+    with open(journal.journal_path, "w", encoding="utf8") as f:
+        f.write(stale)
+
+    # the snapshot already has the change the old journal holds, replaying it would add 2 twice
+    reloaded = QueueJournal(path)
+    assert queued(json.loads(reloaded.load())["data"]) == [1, 2, 3]
+    assert reloaded.generation == journal.generation
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_matches_playlist(path, seed):
+    rng = random.Random(seed)
+    player, journal = start(path, compact_after=37)
+    playlist = player.playlist
+    count = 0
+
+    for step in range(600):
+        action = rng.random()
+        if action < 0.4:
+            count += 1
+            playlist._add_entry(Entry(count), head=rng.random() < 0.3)
+        elif action < 0.55 and len(playlist):
+            playlist.delete_entry_at_index(rng.randrange(len(playlist)))
+        elif action < 0.65 and len(playlist):
+            playlist.remove(playlist.entries[rng.randrange(len(playlist))])
+        elif action < 0.8 and len(playlist):
+            take(player)
+        elif action < 0.88:
+            playlist.shuffle()
+        elif action < 0.9:
+            playlist.clear()
+        elif action < 0.95:
+            player.current_entry = None
+            journal.record(rng.choice(["finish", "stop"]))
+
+        assert loaded(path) == player.saved(), step
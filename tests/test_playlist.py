@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import types
+
+from yt_dlp.utils import DownloadError
+
+from musicbot.playlist import Playlist
+
+
+class Downloader:
+    """
+    Looks songs up with made up delays, so they finish out of order, and keeps track of how many run at once.
+    """
+
+    download_folder = "audio_cache"
+
+    def __init__(self, songs):
+        self.songs = songs
+        self.running = 0
+        self.most_running = 0
+        self.ytdl = types.SimpleNamespace(
+            prepare_filename=lambda info: "youtube-{}.m4a".format(info["id"])
+        )
+
+    async def safe_extract_info(self, loop, url, **kwargs):
+        return {
+            "webpage_url": "https://www.youtube.com/playlist?list=PL",
+            "entries": [{"id": song} if song else None for song in self.songs],
+        }
+
+    async def extract_info(self, loop, url, **kwargs):
+        song = url.rsplit("=", 1)[1]
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        try:
+            await asyncio.sleep(0.01 * (len(song) % 3))
+        finally:
+            self.running -= 1
+
+        if song.startswith("bad"):
+            raise DownloadError("unavailable")
+        if song.startswith("empty"):
+            return None
+        return {"id": song, "title": song, "duration": 60, "extractor": "youtube"}
+
+
+def playlist_of(songs, concurrency=2):
+    config = types.SimpleNamespace(
+        playlist_concurrency=concurrency, prefetch_songs=0, prefetch_size_limit=0
+    )
+    bot = types.SimpleNamespace(
+        loop=asyncio.get_running_loop(), downloader=Downloader(songs), config=config
+    )
+    return Playlist(bot)
+
+
+def test_youtube_playlist(caplog):
+    songs = ["a", "bb", "bad1", "ccc", None, "dddd", "empty", "e"]
+
+    async def run():
+        playlist = playlist_of(songs)
+        progress = []
+        added = await playlist.async_process_youtube_playlist(
+            "https://www.youtube.com/playlist?list=PL",
+            progress_callback=lambda done, total: progress.append((done, total)),
+            author="someone",
+        )
+        return playlist, added, progress
+
+    with caplog.at_level(logging.INFO, logger="musicbot.playlist"):
+        playlist, added, progress = asyncio.run(run())
+
+    good = ["a", "bb", "ccc", "dddd", "e"]
+    assert [entry.title for entry in added] == good
+    assert [entry.title for entry in playlist.entries] == good
+    assert added[0].url == "https://www.youtube.com/watch?v=a"
+    assert added[0].meta == {"author": "someone"}
+    assert progress == [(n, len(songs)) for n in range(1, len(songs) + 1)]
+    assert playlist.downloader.most_running == 2
+    # the missing one, the one that failed and the one nothing was found for
+    assert "Skipped 3 bad entries" in caplog.messages
+
+
+def test_youtube_playlist_at_head():
+    # added to the end first, then the same songs again in front of them
+    async def run():
+        playlist = playlist_of(["a", "bb", "ccc"], concurrency=3)
+        await playlist.async_process_youtube_playlist("x")
+        added = await playlist.async_process_youtube_playlist("x", head=True)
+        return playlist, added
+
+    playlist, added = asyncio.run(run())
+    assert [entry.title for entry in added] == ["a", "bb", "ccc"]
+    assert [entry.title for entry in playlist.entries] == ["a", "bb", "ccc"] * 2
+    assert list(playlist.entries)[:3] == added
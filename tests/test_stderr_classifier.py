@@ -0,0 +1,77 @@
+import re
+
+import pytest
+
+from musicbot.exceptions import FFmpegError, FFmpegWarning
+from musicbot.player import StderrClassifier
+
+
+def test_builtin_patterns():
+    classifier = StderrClassifier()
+
+    assert classifier.classify(b"[mp3 @ 0x1] Header missing\n") is FFmpegWarning
+    assert classifier.classify(b"Last message repeated 3 times") is FFmpegWarning
+    assert (
+        classifier.classify(b"pipe:0: Invalid data found when processing input")
+        is FFmpegError
+    )
+    assert classifier.classify(b"size=  1024kB time=00:00:10.00") is None
+
+
+def test_builtin_patterns_are_plain_text():
+    # "." in a built-in message only matches a dot
+    classifier = StderrClassifier()
+    assert (
+        classifier.classify(
+            b"Using AVStream.codec to pass codec parameters to muxers is deprecated, use AVStream.codecpar instead."
+        )
+        is FFmpegWarning
+    )
+    assert (
+        classifier.classify(
+            b"Using AVStreamXcodec to pass codec parameters to muxers is deprecated, use AVStream.codecpar instead."
+        )
+        is None
+    )
+
+
+def test_extra_patterns_with_inline_flags():
+    classifier = StderrClassifier(
+        warnings=["(?i)connection reset"], errors=["(?i)^fatal"]
+    )
+
+    assert classifier.classify(b"Connection RESET by peer") is FFmpegWarning
+    assert classifier.classify(b"FATAL: out of memory") is FFmpegError
+    assert classifier.classify(b"not fatal") is None
+
+
+def test_extra_patterns_with_backreferences():
+    classifier = StderrClassifier(warnings=[r"(\w+) \1"])
+
+    assert classifier.classify(b"again again") is FFmpegWarning
+    assert classifier.classify(b"again and") is None
+    # the built-in patterns still work next to an extra pattern with its own groups
+    assert classifier.classify(b"Header missing") is FFmpegWarning
+
+
+def test_extra_patterns_come_first():
+    # an extra error pattern can override a built-in warning
+    classifier = StderrClassifier(errors=["Header missing"])
+    assert classifier.classify(b"Header missing") is FFmpegError
+
+
+def test_stats():
+    classifier = StderrClassifier(warnings=["(?i)slow"])
+
+    for line in (b"Header missing", b"Header missing", b"SLOW down", b"other"):
+        classifier.classify(line)
+
+    assert classifier.stats == {
+        "lines": 4,
+        "matches": {"Header missing": 2, "(?i)slow": 1},
+    }
+
+
+def test_invalid_pattern():
+    with pytest.raises(re.error):
+        StderrClassifier(warnings=["(unclosed"])
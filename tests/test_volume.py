@@ -0,0 +1,71 @@
+import random
+import struct
+
+import pytest
+
+from musicbot.volume import MAX_VOLUME, available_engines, mix, scale
+
+engines = pytest.mark.parametrize("engine", available_engines())
+
+
+def frame_of(samples):
+    return struct.pack("<%dh" % len(samples), *samples)
+
+
+def samples_of(frame):
+    return struct.unpack("<%dh" % (len(frame) // 2), frame)
+
+
+def clip(value):
+    return min(0x7FFF, max(-0x8000, value))
+
+
+def assert_close(frame, expected, steps=1):
+    # engines round differently, but only by a step for each time they round
+    got = samples_of(frame)
+    assert len(got) == len(expected)
+    assert max(abs(a - b) for a, b in zip(got, expected)) <= steps
+
+
+@pytest.fixture
+def samples():
+    rng = random.Random(0)
+    return [rng.randint(-0x8000, 0x7FFF) for _ in range(1920 * 2)]
+
+
+@engines
+@pytest.mark.parametrize("volume", [0, 0.3, 1, 1.7])
+def test_scale(engine, volume, samples):
+    frame = scale(frame_of(samples), volume, engine=engine)
+    assert_close(frame, [clip(int(s * volume)) for s in samples])
+
+
+@engines
+def test_scale_clamps_volume(engine, samples):
+    frame = scale(frame_of(samples), 5, engine=engine)
+    assert_close(frame, [clip(int(s * MAX_VOLUME)) for s in samples])
+
+
+@engines
+def test_scale_ramps(engine):
+    frame = scale(frame_of([10000] * 1920 * 2), 1, 0, engine=engine)
+    got = samples_of(frame)
+
+    assert got[0] < 2000
+    assert got[-1] > 8000
+    assert list(got) == sorted(got)
+
+
+@engines
+def test_mix(engine, samples):
+    other = samples[::-1]
+    frame = mix(frame_of(samples), frame_of(other), 0.25, engine=engine)
+    assert_close(
+        frame, [int(a * 0.75 + b * 0.25) for a, b in zip(samples, other)], steps=2
+    )
+
+
+def test_mix_mismatched_frames():
+    short, full = frame_of([1] * 4), frame_of([2] * 8)
+    assert mix(short, full, 0.4) is short
+    assert mix(short, full, 0.6) is full